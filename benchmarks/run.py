@@ -0,0 +1,328 @@
+import argparse
+import contextlib
+from datetime import datetime as dt
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+
+import numpy as np
+
+
+from src.accounts import Four01k, IRA
+from src.allocations import custom_allocation, get_vanguard_glide_path, simple_allocation
+from src.computations import (
+    calc_rmd,
+    compute_period_returns,
+    compute_period_returns_with_rmd,
+    run_simulations,
+    simulate,
+    simulate_batch,
+    summarize_simulations,
+)
+from src.inputs import HistoricalInputs, ParametricOptimizationInputs
+from src.retiree import Retiree, make_ret_arrays, make_ret_df
+from src.ssi import calc_ssi
+from src.tax_computations import IncomeTaxes, compute_income_taxes
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+LIFE_EXPECTANCY = 120
+
+
+def measure(func: Callable, repeat: int = 3, trace_memory: bool = True) -> Dict[str, float]:
+    # Best-of-repeat wall time, then one extra traced call for the peak of Python/numpy allocations
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    stats = dict(seconds=min(times), mean_seconds=float(np.mean(times)))
+    if trace_memory:
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+    return stats
+
+
+def make_retiree(horizon: int):
+    # The simulated window runs from the retiree's age to LIFE_EXPECTANCY, so the age sets the horizon.
+    # The birth year is kept within the SSI earnings table.
+    age = LIFE_EXPECTANCY + 1 - horizon
+    retiree = Retiree(
+        age=age,
+        year=2020 + age,
+        current_income=150_000,
+        desired_retirement_income=90_000,
+        min_net_income=60_000,
+        retirement_age=max(age, 67),
+        life_expectancy=LIFE_EXPECTANCY,
+        inflation_rate=0.02,
+    )
+    retiree_401k = Four01k(retiree=retiree)
+    retiree_ira = IRA(retiree=retiree)
+    retiree_df = make_ret_df(retiree, retiree_401k, retiree_ira, starting_roth_401k=100_000)
+    return retiree, retiree_401k, retiree_ira, retiree_df
+
+
+def make_strategies(n_strategies: int) -> Dict[str, np.ndarray]:
+    generators = [
+        lambda i: get_vanguard_glide_path(default=i % 2 == 0, max_age=LIFE_EXPECTANCY),
+        lambda i: custom_allocation(
+            max_age=LIFE_EXPECTANCY, inflection_points=[0, 1], stock_pcts=[0.4 + 0.05 * (i % 12)] * 2),
+        lambda i: simple_allocation(max_age=LIFE_EXPECTANCY, stock_rule=100 + 5 * (i % 6)),
+    ]
+    return {f'strategy {i}': generators[i % len(generators)](i) for i in range(n_strategies)}
+
+
+def add_result(results: List[Dict], name: str, params: Dict, stats: Dict, paths: int = 0, years: int = 0):
+    result = dict(name=name, params=params, **stats)
+    if paths and years:
+        result['paths_years_per_second'] = paths * years / stats['seconds']
+    results.append(result)
+    throughput = f", {result['paths_years_per_second']:,.0f} path-years/s" if 'paths_years_per_second' in result else ''
+    peak = f", peak {stats['peak_mb']:,.1f} MB" if 'peak_mb' in stats else ''
+    print(f"{name} {params}: {stats['seconds']:.4f}s{throughput}{peak}")
+
+
+def bench_period_returns(results: List[Dict], horizons: List[int], repeat: int):
+    rng = np.random.default_rng(0)
+    for horizon in horizons:
+        contributions = rng.uniform(0, 20_000, horizon)
+        allocations = custom_allocation(max_age=horizon - 1)
+        rates = ParametricOptimizationInputs(seed=0).generate_normal(horizon)
+        rmd = np.linspace(1, 0.2, horizon)
+        add_result(results, 'compute_period_returns', dict(horizon=horizon), measure(
+            lambda: compute_period_returns(contributions, allocations, rates), repeat), 1, horizon)
+        add_result(results, 'compute_period_returns_with_rmd', dict(horizon=horizon), measure(
+            lambda: compute_period_returns_with_rmd(contributions, allocations, rates, rmd), repeat), 1, horizon)
+
+
+def bench_simulate(results: List[Dict], n_sims_list: List[int], horizons: List[int], repeat: int, max_result_gb: float):
+    for horizon in horizons:
+        retiree, _, _, retiree_df = make_retiree(horizon)
+        rmd_t, rmd_r = calc_rmd(retiree)
+        window = slice(retiree.age, LIFE_EXPECTANCY + 1)
+        inputs = dict(
+            roth_contrib=retiree_df['total_roth_dep'].values[window],
+            trad_contrib=retiree_df['total_trad_dep'].values[window],
+            withdrawal=retiree_df['with'].values[window],
+            rmd_take=rmd_t[window],
+            rmd_remain=rmd_r[window],
+            tax_rate=retiree.effective_tax_rate,
+            inflation=retiree.inflation_arr[window],
+        )
+        allocations = get_vanguard_glide_path(max_age=LIFE_EXPECTANCY)[window]
+        for n_sims in n_sims_list:
+            if result_gb(n_sims, horizon, 1) + n_sims * horizon * 3 * 8 / 1024 ** 3 > max_result_gb:
+                continue
+            rates = ParametricOptimizationInputs(seed=0).generate_batch(n_sims, horizon)
+            # simulate is the per-step reference kernel; simulate_batch runs the fused kernel in chunks
+            add_result(results, 'simulate', dict(n_sims=n_sims, horizon=horizon), measure(
+                lambda: simulate(allocations=allocations, rates=rates, **inputs), repeat), n_sims, horizon)
+            add_result(results, 'simulate_batch', dict(n_sims=n_sims, horizon=horizon), measure(
+                lambda: simulate_batch(allocations=allocations, rates=rates, **inputs), repeat), n_sims, horizon)
+
+
+def result_gb(n_sims: int, horizon: int, n_strategies: int) -> float:
+    # Six float64 (years, n_sims) matrices per strategy
+    return 6 * 8 * n_sims * horizon * n_strategies / 1024 ** 3
+
+
+def bench_run_simulations(
+        results: List[Dict],
+        n_sims_list: List[int],
+        horizons: List[int],
+        strategy_counts: List[int],
+        repeat: int,
+        max_result_gb: float,
+):
+    for horizon in horizons:
+        retiree, _, _, retiree_df = make_retiree(horizon)
+        for n_strategies in strategy_counts:
+            strategies = make_strategies(n_strategies)
+            for n_sims in n_sims_list:
+                params = dict(n_sims=n_sims, horizon=horizon, n_strategies=n_strategies)
+                run_kwargs = dict(
+                    ret=retiree,
+                    ret_df=retiree_df,
+                    allocation_strats=strategies,
+                    start_age=retiree.age,
+                    end_age=LIFE_EXPECTANCY,
+                    n_sims=n_sims,
+                )
+                if result_gb(n_sims, horizon, n_strategies) <= max_result_gb:
+                    add_result(results, 'run_simulations', params, measure(
+                        lambda: run_simulations(rng=ParametricOptimizationInputs(seed=0), **run_kwargs), repeat),
+                        n_sims * n_strategies, horizon)
+                add_result(results, 'summarize_simulations', params, measure(
+                    lambda: summarize_simulations(rng=ParametricOptimizationInputs(seed=0), **run_kwargs), repeat),
+                    n_sims * n_strategies, horizon)
+
+
+def bench_taxes(results: List[Dict], repeat: int):
+    incomes = np.random.default_rng(0).uniform(0, 500_000, 10_000).round(2)
+    n_rows = 1_000
+    add_result(results, 'IncomeTaxes', dict(n_incomes=n_rows), measure(
+        lambda: [IncomeTaxes(float(x), 'NY', 'NYC', 2022).get_after_tax_income() for x in incomes[:n_rows]], repeat))
+    add_result(results, 'compute_income_taxes', dict(n_incomes=incomes.shape[0]), measure(
+        lambda: compute_income_taxes(incomes, 'NY', 'NYC', 2022), repeat))
+
+
+def bench_retirees(results: List[Dict], repeat: int, n_retirees: int = 500):
+    retiree, retiree_401k, retiree_ira, _ = make_retiree(LIFE_EXPECTANCY + 1 - 40)
+    add_result(results, 'make_ret_df', dict(n_retirees=1), measure(
+        lambda: make_ret_df(retiree, retiree_401k, retiree_ira), repeat))
+    add_result(results, 'calc_ssi', dict(n_retirees=1), measure(lambda: calc_ssi(retiree), repeat))
+    rng = np.random.default_rng(0)
+    rets = [
+        Retiree(age=40, year=2060, current_income=float(income), desired_retirement_income=90_000, min_net_income=60_000)
+        for income in rng.uniform(50_000, 400_000, n_retirees)
+    ]
+    accounts_401k = [Four01k(retiree=ret) for ret in rets]
+    accounts_ira = [IRA(retiree=ret) for ret in rets]
+    add_result(results, 'make_ret_arrays', dict(n_retirees=n_retirees), measure(
+        lambda: make_ret_arrays(rets, accounts_401k, accounts_ira), repeat))
+
+
+def bench_historical(results: List[Dict], repeat: int, filepath: Optional[str] = None, sheetname: Optional[str] = None):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if filepath is None:
+            try:
+                import pandas as pd
+                years = np.arange(1871, 2022)
+                rng = np.random.default_rng(0)
+                filepath = os.path.join(tmp_dir, 'returns.xlsx')
+                pd.DataFrame(dict(
+                    year=years,
+                    stocks=rng.normal(0.07, 0.18, years.shape[0]),
+                    bonds=rng.normal(0.02, 0.07, years.shape[0]),
+                )).to_excel(filepath, sheet_name='returns', index=False)
+                sheetname = 'returns'
+            except ImportError as e:
+                print(f'Skipping HistoricalInputs: {e}')
+                return
+        elif sheetname is None:
+            sheetname = HistoricalInputs.sheetname
+        cache_dir = os.path.join(tmp_dir, 'historical')
+        # Fill the cache so the cached case times only the load, not the first import
+        HistoricalInputs(filepath, sheetname, 1926, cache_dir=cache_dir)
+        add_result(results, 'HistoricalInputs', dict(cached=False), measure(
+            lambda: HistoricalInputs(filepath, sheetname, 1926, cache_dir=tempfile.mkdtemp(dir=tmp_dir)), repeat))
+        add_result(results, 'HistoricalInputs', dict(cached=True), measure(
+            lambda: HistoricalInputs(filepath, sheetname, 1926, cache_dir=cache_dir), repeat))
+
+
+def bench_plots(results: List[Dict], n_sims_list: List[int], repeat: int, max_plot_sims: int = 10_000):
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from src.plots import plot_ending_balance_hist, plot_time_series
+
+    horizon = 51
+    retiree, _, _, retiree_df = make_retiree(horizon)
+    strategies = make_strategies(3)
+    years = retiree.years_arr[retiree.age:]
+    for n_sims in n_sims_list:
+        if n_sims > max_plot_sims:
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):
+            sim_results = run_simulations(
+                retiree, retiree_df, strategies, ParametricOptimizationInputs(seed=0),
+                start_age=retiree.age, end_age=LIFE_EXPECTANCY, n_sims=n_sims)
+        ending = {k: (v['traditional_balance'] + v['roth_balance'])[-1] for k, v in sim_results.items()}
+
+        def render(plot):
+            fig, _ = plot()
+            fig.canvas.draw()
+            plt.close(fig)
+
+        params = dict(n_sims=n_sims, n_strategies=3, horizon=horizon)
+        add_result(results, 'plot_time_series', dict(mode='fan', **params), measure(
+            lambda: render(lambda: plot_time_series(sim_results, years, mode='fan', n_sample_paths=20)), repeat, False))
+        if n_sims <= 100:
+            add_result(results, 'plot_time_series', dict(mode='paths', **params), measure(
+                lambda: render(lambda: plot_time_series(sim_results, years)), 1, False))
+        add_result(results, 'plot_ending_balance_hist', params, measure(
+            lambda: render(lambda: plot_ending_balance_hist(
+                ending, n_sims, retiree.age, LIFE_EXPECTANCY, bin_width=1)), repeat, False))
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(
+        timestamp=dt.now().isoformat(timespec='seconds'),
+        commit=commit,
+        python=sys.version.split()[0],
+        numpy=np.__version__,
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+    )
+
+
+BENCHMARKS = ['period_returns', 'simulate', 'run_simulations', 'taxes', 'retirees', 'historical', 'plots']
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Benchmark the simulation, tax and plotting hot paths.')
+    parser.add_argument('--n-sims', type=int, nargs='+', default=[100, 1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--horizons', type=int, nargs='+', default=[30, 60, 90, 120])
+    parser.add_argument('--strategies', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-result-gb', type=float, default=4.,
+                        help='Skip in-memory runs whose result matrices would exceed this size')
+    parser.add_argument('--historical-file', default=None,
+                        help='Workbook for the HistoricalInputs benchmark (default: a generated one)')
+    parser.add_argument('--historical-sheet', default=None,
+                        help=f'Sheet of --historical-file to read (default: {HistoricalInputs.sheetname!r})')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--quick', action='store_true', help='Small sweep for a fast smoke run')
+    parser.add_argument('--output', default=None, help='JSON file to write (default: benchmarks/results/)')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.n_sims, args.horizons, args.strategies, args.repeat = [100, 1_000], [30, 60], [1, 4], 1
+
+    results = []
+    if 'period_returns' in args.only:
+        bench_period_returns(results, args.horizons, args.repeat)
+    if 'simulate' in args.only:
+        bench_simulate(results, args.n_sims, args.horizons, args.repeat, args.max_result_gb)
+    if 'run_simulations' in args.only:
+        bench_run_simulations(results, args.n_sims, args.horizons, args.strategies, args.repeat, args.max_result_gb)
+    if 'taxes' in args.only:
+        bench_taxes(results, args.repeat)
+    if 'retirees' in args.only:
+        bench_retirees(results, args.repeat)
+    if 'historical' in args.only:
+        bench_historical(results, args.repeat, args.historical_file, args.historical_sheet)
+    if 'plots' in args.only:
+        bench_plots(results, args.n_sims, args.repeat)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f'benchmark-{dt.now():%Y%m%d-%H%M%S}.json')
+    with open(output, 'w') as f:
+        json.dump(dict(environment=environment(), results=results), f, indent=2)
+    print(f'Wrote {len(results)} results to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+from dataclasses import dataclass
+import hashlib
+import os
+from typing import Dict, Optional
+
+
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+# Bump when the simulation engine changes in a way that alters results
+CACHE_VERSION = 1
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, np.ndarray):
+        h.update(f'ndarray:{obj.dtype.str}:{obj.shape}:'.encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update(f'dict:{len(obj)}:'.encode())
+        for k in sorted(obj, key=str):
+            _update_hash(h, k)
+            _update_hash(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}:{len(obj)}:'.encode())
+        for v in obj:
+            _update_hash(h, v)
+    else:
+        h.update(f'{type(obj).__name__}:{obj!r};'.encode())
+
+
+@dataclass
+class ResultCache:
+    cache_dir: str = DEFAULT_CACHE_DIR
+    max_bytes: int = 2 * 1024 ** 3
+
+    def __post_init__(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def make_key(self, *parts) -> str:
+        h = hashlib.sha256()
+        _update_hash(h, (CACHE_VERSION,) + parts)
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            results = {k: data[k] for k in data.files}
+        # Touch the entry so eviction is least-recently-used rather than least-recently-written
+        os.utime(path)
+        return results
+
+    def put(self, key: str, results: Dict[str, np.ndarray]):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **results)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total_bytes -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.cache_dir, name))
@@ -4,6 +4,7 @@ from dataclasses import dataclass
 import numpy as np
 
 
+from src.derived import DependencyTracked, derived
 from src.interfaces import RetireeClass as Retiree
 
 
@@ -16,7 +17,7 @@ def reduced_roth_ira(modified_agi: float, thresh: float = 138_000., max_limit: f
 
 
 @dataclass
-class IRA:
+class IRA(DependencyTracked):
     retiree: Retiree
     current_total_max_lt: float = 6_500.
     current_total_max_gte: float = 7_500.
@@ -24,11 +25,13 @@ class IRA:
     estimated_max_growth: float = 0.005
     estimated_max_lag: int = 10
     inflection_year: int = 50
-    
-    def __post_init__(self):
-        self.__calc_ira_array()
-        
-    def __calc_ira_array(self):
+
+    @derived(
+        'retiree.ages_arr', 'retiree.age', 'retiree.retirement_age', 'retiree.life_expectancy', 'retiree.income_arr',
+        'current_total_max_lt', 'current_total_max_gte', 'income_limit', 'estimated_max_growth',
+        'estimated_max_lag', 'inflection_year',
+    )
+    def _ira_arrays(self):
         inflection_mask = self.retiree.ages_arr[self.retiree.age:self.retiree.retirement_age + 1] < self.inflection_year
         total_max_arr = np.where(inflection_mask, self.current_total_max_lt, self.current_total_max_gte)
         
@@ -38,18 +41,26 @@ class IRA:
         pad_width = (self.retiree.age, self.retiree.life_expectancy - self.retiree.retirement_age)
         
         income_limit_growth = (self.income_limit * growth).round(2)
-        self.total_max_arr = total_max_arr * growth
-        self.roth_max_arr = reduced_roth_ira(
+        total_max_arr = total_max_arr * growth
+        roth_max_arr = reduced_roth_ira(
             modified_agi=self.retiree.income_arr[self.retiree.age:self.retiree.retirement_age + 1],
             thresh=income_limit_growth,
-            max_limit=self.total_max_arr,
+            max_limit=total_max_arr,
         )
         
-        self.total_max_arr = np.pad(self.total_max_arr, pad_width).round(2)
-        self.roth_max_arr = np.pad(self.roth_max_arr, pad_width).round(2)
+        return np.pad(total_max_arr, pad_width).round(2), np.pad(roth_max_arr, pad_width).round(2)
+
+    @derived('_ira_arrays')
+    def total_max_arr(self) -> np.ndarray:
+        return self._ira_arrays[0]
+
+    @derived('_ira_arrays')
+    def roth_max_arr(self) -> np.ndarray:
+        return self._ira_arrays[1]
+
 
 @dataclass
-class Four01k:
+class Four01k(DependencyTracked):
     retiree: Retiree
     current_employee_max_lt: float = 22_500.
     current_employee_max_gte: float = 30_000.
@@ -60,27 +71,35 @@ class Four01k:
     estimated_max_growth: float = 0.005
     estimated_max_lag: int = 10
     inflection_year: int = 50
-    
-    def __post_init__(self):
-        self.__calc_401k_array()
-        
-    def __calc_401k_array(self):
-        inflection_mask = self.retiree.ages_arr[self.retiree.age:self.retiree.retirement_age + 1] < self.inflection_year
-        
-        self.employee_max_arr = np.where(inflection_mask, self.current_employee_max_lt, self.current_employee_max_gte)
-        self.combined_max_arr = np.where(inflection_mask, self.current_combined_max_lt, self.current_combined_max_gte)
-        
-        growth = np.ones_like(self.employee_max_arr)
+
+    @derived('retiree.age', 'retiree.retirement_age', 'estimated_max_growth', 'estimated_max_lag')
+    def _growth(self) -> np.ndarray:
+        growth = np.ones(self.retiree.retirement_age - self.retiree.age + 1)
         growth[self.estimated_max_lag::self.estimated_max_lag] += self.estimated_max_growth
-        growth = growth.cumprod()
+        return growth.cumprod()
 
-        pad_width = (self.retiree.age, self.retiree.life_expectancy - self.retiree.retirement_age)
-        
-        self.employee_max_arr = np.pad(growth * self.employee_max_arr, pad_width).round(2)
-        self.roth_max_arr = np.clip(self.retiree.desired_retirement_income - self.employee_max_arr,
-                                    0., self.employee_max_arr).round(2)
-        self.roth_max_arr = np.where(self.retiree.income_arr < self.retiree.desired_retirement_income,self.roth_max_arr, 0)
-        self.combined_max_arr = np.pad(growth * self.combined_max_arr, pad_width).round(2)
+    @derived('retiree.ages_arr', 'retiree.age', 'retiree.retirement_age', 'inflection_year')
+    def _inflection_mask(self) -> np.ndarray:
+        return self.retiree.ages_arr[self.retiree.age:self.retiree.retirement_age + 1] < self.inflection_year
+
+    def _pad(self, arr: np.ndarray) -> np.ndarray:
+        return np.pad(arr, (self.retiree.age, self.retiree.life_expectancy - self.retiree.retirement_age))
+
+    @derived('_inflection_mask', '_growth', 'retiree.life_expectancy', 'current_employee_max_lt', 'current_employee_max_gte')
+    def employee_max_arr(self) -> np.ndarray:
+        employee_max_arr = np.where(self._inflection_mask, self.current_employee_max_lt, self.current_employee_max_gte)
+        return self._pad(self._growth * employee_max_arr).round(2)
+
+    @derived('_inflection_mask', '_growth', 'retiree.life_expectancy', 'current_combined_max_lt', 'current_combined_max_gte')
+    def combined_max_arr(self) -> np.ndarray:
+        combined_max_arr = np.where(self._inflection_mask, self.current_combined_max_lt, self.current_combined_max_gte)
+        return self._pad(self._growth * combined_max_arr).round(2)
+
+    @derived('employee_max_arr', 'retiree.desired_retirement_income', 'retiree.income_arr')
+    def roth_max_arr(self) -> np.ndarray:
+        roth_max_arr = np.clip(self.retiree.desired_retirement_income - self.employee_max_arr,
+                               0., self.employee_max_arr).round(2)
+        return np.where(self.retiree.income_arr < self.retiree.desired_retirement_income, roth_max_arr, 0)
 
     def employer_max_arr(self, employee_max_arr):
         return np.clip(
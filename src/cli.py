@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+
+import numpy as np
+
+
+from src import allocations
+from src.accounts import Four01k, IRA
+from src.computations import DEFAULT_CHUNK_SIZE, DEFAULT_SHARD_SIZE, compute_shortfall, run_simulations
+from src.inputs import HistoricalInputs, ParametricOptimizationInputs
+from src.instrumentation import Instrumentation
+from src.retiree import Retiree, make_ret_arrays
+from src.storage import load_results
+
+# Headless entry point: python -m src scenario.json --output DIR. Only numpy is imported up front; pandas is
+# only needed to read a historical workbook that is not cached yet, and nothing here plots.
+
+GENERATORS = dict(
+    custom_allocation=allocations.custom_allocation,
+    simple_allocation=allocations.simple_allocation,
+    vanguard=allocations.get_vanguard_glide_path,
+    get_vanguard_glide_path=allocations.get_vanguard_glide_path,
+)
+RNG_TYPES = dict(
+    parametric=ParametricOptimizationInputs,
+    historical=HistoricalInputs,
+)
+# Scenario values given as JSON lists that the inputs expect as arrays
+ARRAY_KWARGS = ('income_history', 'arithmetic_means', 'geometric_means', 'stds', 'corr_matrix')
+SUMMARY_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def _arrays(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: np.asarray(v) if k in ARRAY_KWARGS and v is not None else v for k, v in kwargs.items()}
+
+
+def load_scenario(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        scenario = json.load(f)
+    for section in ('retiree', 'strategies'):
+        if section not in scenario:
+            raise ValueError(f'Scenario {path} has no {section!r} section')
+    return scenario
+
+
+def make_rng(config: Dict[str, Any]) -> Union[ParametricOptimizationInputs, HistoricalInputs]:
+    config = dict(config)
+    rng_type = config.pop('type', 'parametric')
+    if rng_type not in RNG_TYPES:
+        raise ValueError(f'rng type must be one of {tuple(RNG_TYPES)}')
+    return RNG_TYPES[rng_type](**_arrays(config))
+
+
+def make_strategies(config: Dict[str, Dict[str, Any]], max_age: int) -> Dict[str, np.ndarray]:
+    # {name: {"generator": ..., "params": {...}}}; max_age defaults to the retiree's life_expectancy
+    strategies = dict()
+    for name, strategy in config.items():
+        if strategy.get('generator') not in GENERATORS:
+            raise ValueError(f'Strategy {name!r}: generator must be one of {tuple(GENERATORS)}')
+        strategies[name] = GENERATORS[strategy['generator']](**{'max_age': max_age, **strategy.get('params', dict())})
+    return strategies
+
+
+def summarize_results(
+    ret: Retiree,
+    results: Dict[str, Dict[str, np.ndarray]],
+    start_age: int,
+    end_age: int,
+    percentiles: Sequence[float] = SUMMARY_PERCENTILES,
+) -> Dict[str, Dict[str, float]]:
+    # Ending-balance statistics and the probability of running out of money after retirement, per strategy
+    retired = ret.ages_arr[start_age: end_age+1] > ret.retirement_age
+    summary = dict()
+    for key, strat_results in results.items():
+        stats = dict()
+        for suffix in ('', '_real'):
+            ending = strat_results[f'traditional_balance{suffix}'][-1] + strat_results[f'roth_balance{suffix}'][-1]
+            stats[f'ending_balance{suffix}_mean'] = float(ending.mean())
+            for p, value in zip(percentiles, np.percentile(ending, percentiles)):
+                stats[f'ending_balance{suffix}_p{p:g}'] = float(value)
+        depleted = compute_shortfall(strat_results['roth_withdrawals'], strat_results['roth_balance'], retired)
+        stats['depletion_probability'] = float(depleted.mean())
+        summary[key] = stats
+    return summary
+
+
+def make_retiree_inputs(scenario: Dict[str, Any]) -> Tuple[Retiree, Dict[str, np.ndarray]]:
+    # The retiree and its contribution columns, which run_simulations takes in place of make_ret_df
+    ret = Retiree(**_arrays(scenario['retiree']))
+    ret_401k = Four01k(retiree=ret, **scenario.get('four01k', dict()))
+    ret_ira = IRA(retiree=ret, **scenario.get('ira', dict()))
+    ret_arrays = make_ret_arrays([ret], [ret_401k], [ret_ira], **scenario.get('starting_balances', dict()))
+    return ret, {col: arr[0] for col, arr in ret_arrays.items()}
+
+
+def run_scenario(
+    scenario: Dict[str, Any],
+    output_dir: str,
+    write_paths: bool = True,
+    stats: bool = False,
+) -> Dict[str, Any]:
+    ret, ret_columns = make_retiree_inputs(scenario)
+    strategies = make_strategies(scenario['strategies'], ret.life_expectancy)
+    rng = make_rng(scenario.get('rng', dict()))
+    start_age = scenario.get('start_age', ret.age)
+    end_age = scenario.get('end_age', ret.life_expectancy)
+    n_sims = scenario.get('n_sims', 10_000)
+
+    os.makedirs(output_dir, exist_ok=True)
+    instrumentation = Instrumentation(track_memory=stats) if stats else None
+    run_dir = os.path.join(output_dir, 'results') if write_paths else None
+    start_time = time.time()
+    results = run_simulations(
+        ret, ret_columns, strategies, rng,
+        start_age=start_age,
+        end_age=end_age,
+        n_sims=n_sims,
+        workers=scenario.get('workers'),
+        shard_size=scenario.get('shard_size', DEFAULT_SHARD_SIZE),
+        chunk_size=scenario.get('chunk_size', DEFAULT_CHUNK_SIZE),
+        run_dir=run_dir,
+        instrumentation=instrumentation,
+    )
+    if run_dir is not None:
+        results = load_results(run_dir)
+    summary = dict(
+        n_sims=n_sims,
+        start_age=start_age,
+        end_age=end_age,
+        seconds=time.time() - start_time,
+        strategies=summarize_results(ret, results, start_age, end_age),
+    )
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    if instrumentation is not None:
+        with open(os.path.join(output_dir, 'stats.txt'), 'w') as f:
+            f.write(instrumentation.stats.report() + '\n')
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m src', description='Run the simulations of a scenario file')
+    parser.add_argument('scenario', help='JSON file with retiree, four01k, ira, starting_balances, strategies, '
+                                         'rng, n_sims, start_age and end_age')
+    parser.add_argument('--output', '-o', required=True, help='directory for results/, summary.json and stats.txt')
+    parser.add_argument('--n-sims', type=int, help='override the n_sims of the scenario')
+    parser.add_argument('--seed', type=int, help='override the rng seed of the scenario')
+    parser.add_argument('--summary-only', action='store_true', help='write summary.json but not the paths')
+    parser.add_argument('--stats', action='store_true', help='write per-stage timings and memory to stats.txt')
+    args = parser.parse_args(argv)
+
+    try:
+        scenario = load_scenario(args.scenario)
+        if args.n_sims is not None:
+            scenario['n_sims'] = args.n_sims
+        if args.seed is not None:
+            scenario['rng'] = {**scenario.get('rng', dict()), 'seed': args.seed}
+        summary = run_scenario(scenario, args.output, write_paths=not args.summary_only, stats=args.stats)
+    except (OSError, ValueError, TypeError) as e:
+        parser.exit(1, f'{parser.prog}: error: {e}\n')
+
+    for key, stats in summary['strategies'].items():
+        print(f"{key}: median real ending balance {stats['ending_balance_real_p50']:,.0f}, "
+              f"depletion probability {stats['depletion_probability']:.1%}")
+    return 0
@@ -1,13 +1,44 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import copy
+import dataclasses
+import functools
+from statistics import NormalDist
 import time
-from typing import Dict, Optional, Union
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 
 import numpy as np
-import pandas as pd
 
 
-from src.inputs import ParametricOptimizationInputs
+from cache.results import ResultCache
+from src.estimators import mean_statistic, percentile_statistic, standard_error
+from src.inputs import HistoricalInputs, ParametricOptimizationInputs
+from src.instrumentation import Instrumentation, StrategyStats
 from src.interfaces import RetireeClass as Retiree
+from src.storage import close_result_arrays, create_result_arrays, load_results
+from src.summaries import SimulationProgress, YearlySummary
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def compute_running_balance(
+        contributions: np.ndarray,
+        rates_ev: np.ndarray,
+) -> np.ndarray:
+    # Balance recurrence B[t] = (B[t-1] + contributions[t]) * (1 + rates_ev[t]), over the trailing axis
+    contributions, rates_ev = np.broadcast_arrays(contributions, rates_ev)
+    contributions = np.moveaxis(contributions, -1, 0)
+    growth = np.moveaxis(rates_ev, -1, 0) + 1
+    balances = np.empty(contributions.shape)
+    balance = np.zeros(contributions.shape[1:])
+    for t in range(contributions.shape[0]):
+        balance = (balance + contributions[t]) * growth[t]
+        balances[t] = balance
+    return np.moveaxis(balances, 0, -1)
 
 
 def compute_period_returns(
@@ -15,11 +46,8 @@ def compute_period_returns(
         allocations: np.ndarray,
         rates: np.ndarray,
 ) -> np.ndarray:
-    rates_ev: np.array = (allocations * rates).sum(axis=1)
-    cum_rates_ev = (np.triu(np.expand_dims(rates_ev, axis=0).repeat(rates_ev.shape[0], axis=0)) + 1).cumprod(axis=1)
-    period_contribs = np.triu(contributions.reshape((-1,1)).repeat(contributions.shape, axis=1))
-    realized_contribs = period_contribs * cum_rates_ev
-    period_balances = realized_contribs.sum(axis=0).reshape((-1,1))
+    rates_ev: np.array = (allocations * rates).sum(axis=-1)
+    period_balances = np.expand_dims(compute_running_balance(contributions, rates_ev), axis=-1)
     return np.clip(period_balances * allocations, 0, None)
 
 
@@ -29,16 +57,17 @@ def compute_period_returns_with_rmd(
         rates: np.ndarray,
         rmd: np.ndarray,
 ) -> np.ndarray:
-    rates_ev: np.array = (allocations * rates).sum(axis=1)
-    cum_rates_ev = (np.triu(np.expand_dims(rates_ev, axis=0).repeat(rates_ev.shape[0], axis=0)) + 1).cumprod(axis=1)
-    cum_rates_ev = cum_rates_ev * rmd
-    period_contribs = np.triu(contributions.reshape((-1,1)).repeat(contributions.shape, axis=1))
-    realized_contribs = period_contribs * cum_rates_ev
-    period_balances = realized_contribs.sum(axis=0).reshape((-1,1))
+    rates_ev: np.array = (allocations * rates).sum(axis=-1)
+    period_balances = np.expand_dims(compute_running_balance(contributions, rates_ev) * rmd, axis=-1)
     return np.clip(period_balances * allocations, 0, None)
 
 
 def calc_rmd(ret: Retiree):
+    return _rmd_arrays(ret.life_expectancy)
+
+
+@functools.lru_cache(maxsize=None)
+def _rmd_arrays(life_expectancy: int) -> Tuple[np.ndarray, np.ndarray]:
     divisors = np.array([
         27.4, 26.5, 25.5, 24.6, 23.7,
         22.9, 22.0, 21.1, 20.2, 19.4,
@@ -55,9 +84,36 @@ def calc_rmd(ret: Retiree):
     rmd_arr = np.concatenate((
         np.repeat(1, rmd_year),
         1 - (1/divisors),
-        np.repeat(1 - (1/divisors[-1]), ret.life_expectancy - rmd_year)
-    ))[:ret.life_expectancy + 1]
-    return 1-rmd_arr, rmd_arr.cumprod()
+        np.repeat(1 - (1/divisors[-1]), life_expectancy - rmd_year)
+    ))[:life_expectancy + 1]
+    rmd_take, rmd_remain = 1-rmd_arr, rmd_arr.cumprod()
+    # Shared by every caller with the same life_expectancy
+    rmd_take.flags.writeable = False
+    rmd_remain.flags.writeable = False
+    return rmd_take, rmd_remain
+
+
+RESULT_FIELDS = (
+    'traditional_balance',
+    'roth_balance',
+    'traditional_balance_real',
+    'roth_balance_real',
+    'traditional_withdrawals',
+    'roth_withdrawals',
+)
+SUMMARY_FIELDS = RESULT_FIELDS + (
+    'portfolio_balance',
+    'portfolio_balance_real',
+)
+
+# Shared by run_simulations, summarize_simulations and iter_simulations, so that the same arguments give
+# the same paths (shards draw from their own child streams, so shard_size changes the paths)
+DEFAULT_CHUNK_SIZE = 10_000
+DEFAULT_SHARD_SIZE = 1_000
+
+
+def _stage(instrumentation: Optional[Instrumentation], name: str):
+    return contextlib.nullcontext() if instrumentation is None else instrumentation.stage(name)
 
 
 def simulate(
@@ -70,108 +126,769 @@ def simulate(
         rmd_remain: np.ndarray,
         tax_rate: float,
         inflation: Optional[Union[float, np.ndarray]] = None,
+        instrumentation: Optional[Instrumentation] = None,
 ):
-    trad = compute_period_returns_with_rmd(
-        contributions=trad_contrib,
-        allocations=allocations,
-        rates=rates,
-        rmd=rmd_remain,
-    ).sum(axis=1).round(2)
-
-#     print(trad.reshape((-1,1)).shape,np.ones_like(trad.reshape((-1,1))).shape,inflation.reshape((-1,1)).shape)
-    trad_infl = compute_period_returns(
-        contributions=np.diff(trad, prepend=0).flatten(),
-        allocations=np.pad(np.ones_like(trad.reshape((-1,1))), (0,1))[:-1],
-        rates=np.pad(inflation.reshape((-1,1)), (0,1))[:-1],
-    ).sum(axis=1).round(2)
+    # rates may carry leading batch axes, e.g. (n_sims, years, assets); outputs are then (n_sims, years)
+    with _stage(instrumentation, 'traditional'):
+        trad = compute_period_returns_with_rmd(
+            contributions=trad_contrib,
+            allocations=allocations,
+            rates=rates,
+            rmd=rmd_remain,
+        ).sum(axis=-1).round(2)
+
+        trad_rmd = ((1 - tax_rate) * trad * np.pad(rmd_take[1:], (0,1), mode='edge')).round(2)
     
-    trad_rmd = ((1 - tax_rate) * trad * np.pad(rmd_take[1:], (0,1), mode='edge')).round(2)
+    with _stage(instrumentation, 'roth'):
+        roth_withdrawal = np.clip(withdrawal - trad_rmd, 0.0, None).round(2)
+
+        roth = np.clip((compute_period_returns(
+            contributions=roth_contrib,
+            allocations=allocations,
+            rates=rates,
+        ).sum(axis=-1).round(2) - compute_period_returns(
+            contributions=roth_withdrawal,
+            allocations=allocations,
+            rates=rates,
+        ).sum(axis=-1).round(2)), 0.0, None).round(2)
     
-    roth_withdrawal = np.clip(withdrawal - trad_rmd, 0.0, None).round(2)
+    with _stage(instrumentation, 'inflation'):
+        trad_infl = compute_period_returns(
+            contributions=np.diff(trad, axis=-1, prepend=0),
+            allocations=np.expand_dims(np.ones_like(trad), axis=-1),
+            rates=np.expand_dims(inflation, axis=-1),
+        ).sum(axis=-1).round(2)
+
+        roth_infl = compute_period_returns(
+            contributions=np.diff(roth, axis=-1, prepend=0),
+            allocations=np.expand_dims(np.ones_like(roth), axis=-1),
+            rates=np.expand_dims(inflation, axis=-1),
+        ).sum(axis=-1).round(2)
     
-    roth = np.clip((compute_period_returns(
-        contributions=roth_contrib,
-        allocations=allocations,
-        rates=rates,
-    ).sum(axis=1).round(2) - compute_period_returns(
-        contributions=roth_withdrawal,
+    return (trad, roth), (trad_infl, roth_infl), (trad_rmd, roth_withdrawal)
+
+
+def make_workspace(batch_shape: tuple, n_years: int, n_assets: int) -> Dict[str, np.ndarray]:
+    # Scratch buffers for simulate_fused, where batch_shape is (..., n_sims). Slicing every buffer to
+    # [..., :n] gives a workspace for fewer paths.
+    n_sims = batch_shape[-1]
+    workspace = {name: np.empty(batch_shape) for name in (
+        'rates_ev', 'growth', 'term', 'change', 'trad_rmd', 'roth_withdrawal', 'roth_contrib_value',
+        'roth_withdrawal_value', 'trad_balance', 'roth_contrib_balance', 'roth_withdrawal_balance',
+        'trad_infl_balance', 'roth_infl_balance',
+    )}
+    workspace['rates'] = np.empty((n_years, n_assets, n_sims))
+    return workspace
+
+
+def simulate_fused(
+        roth_contrib: np.ndarray,
+        trad_contrib: np.ndarray,
+        withdrawal: np.ndarray,
+        allocations: np.ndarray,
+        rates: np.ndarray,
+        rmd_take: np.ndarray,
+        rmd_remain: np.ndarray,
+        tax_rate: float,
+        inflation: Optional[Union[float, np.ndarray]] = None,
+        out: Optional[Dict[str, np.ndarray]] = None,
+        workspace: Optional[Dict[str, np.ndarray]] = None,
+        round_each_step: bool = True,
+        instrumentation: Optional[Instrumentation] = None,
+) -> Dict[str, np.ndarray]:
+    # Every leg of simulate in one forward pass over the years, writing straight into (..., years, n_sims)
+    # outputs. allocations is (years, assets) or (n_strategies, years, assets) and rates is
+    # (n_sims, years, assets). The per-year inputs are (years,), or carry leading axes (and tax_rate the
+    # same axes) that broadcast against (n_strategies, n_sims), e.g. (n_scenarios, 1, 1, years).
+    # With round_each_step the intermediate .round(2) calls of simulate are kept and, as the asset sums run
+    # in numpy's order, the outputs match it exactly; without them values are only rounded by
+    # simulate_batch at output time.
+    n_sims, n_years, n_assets = rates.shape
+    inflation = np.broadcast_to(0. if inflation is None else inflation, np.shape(inflation)[:-1] + (n_years,))
+    batch_shape = np.broadcast_shapes(
+        allocations.shape[:-2] + (n_sims,),
+        np.shape(tax_rate),
+        *(np.shape(arr)[:-1] for arr in (roth_contrib, trad_contrib, withdrawal, rmd_take, rmd_remain, inflation)),
+    )
+    if out is None:
+        out = {field: np.empty(batch_shape[:-1] + (n_years, n_sims)) for field in RESULT_FIELDS}
+    if workspace is None or workspace['rates_ev'].shape != batch_shape:
+        workspace = make_workspace(batch_shape, n_years, n_assets)
+    w = workspace
+    for name in ('trad_balance', 'roth_contrib_balance', 'roth_withdrawal_balance', 'trad_infl_balance',
+                 'roth_infl_balance'):
+        w[name].fill(0.)
+    # (years, assets, n_sims), so every step works on contiguous rows of paths
+    np.copyto(w['rates'], np.moveaxis(rates, 0, -1))
+    rates = w['rates']
+    weights = allocations[..., None]
+    rmd_take_next = np.concatenate((rmd_take[..., 1:], rmd_take[..., -1:]), axis=-1)
+    trad_keep = 1 - tax_rate
+
+    def round_2(arr):
+        if round_each_step:
+            arr.round(2, out=arr)
+
+    def period_value(balance, t, value):
+        # clip(balance * allocations, 0).sum(axis=-1) as in compute_period_returns, an asset at a time
+        for a in range(n_assets):
+            np.multiply(balance, weights[..., t, a, :], out=w['term'])
+            np.clip(w['term'], 0, None, out=w['term'])
+            if a == 0:
+                value[...] = w['term']
+            else:
+                np.add(value, w['term'], out=value)
+        round_2(value)
+
+    for t in range(n_years):
+        trad, roth = out['traditional_balance'][..., t, :], out['roth_balance'][..., t, :]
+        with _stage(instrumentation, 'traditional'):
+            for a in range(n_assets):
+                np.multiply(weights[..., t, a, :], rates[t, a], out=w['term'])
+                if a == 0:
+                    w['rates_ev'][...] = w['term']
+                else:
+                    np.add(w['rates_ev'], w['term'], out=w['rates_ev'])
+            np.add(w['rates_ev'], 1, out=w['growth'])
+            np.add(w['trad_balance'], trad_contrib[..., t], out=w['trad_balance'])
+            np.multiply(w['trad_balance'], w['growth'], out=w['trad_balance'])
+            np.multiply(w['trad_balance'], rmd_remain[..., t], out=w['change'])
+            period_value(w['change'], t, trad)
+            np.multiply(trad, trad_keep, out=w['trad_rmd'])
+            np.multiply(w['trad_rmd'], rmd_take_next[..., t], out=w['trad_rmd'])
+            round_2(w['trad_rmd'])
+        with _stage(instrumentation, 'roth'):
+            np.subtract(withdrawal[..., t], w['trad_rmd'], out=w['roth_withdrawal'])
+            np.clip(w['roth_withdrawal'], 0., None, out=w['roth_withdrawal'])
+            round_2(w['roth_withdrawal'])
+            for balance, contrib, value in (
+                ('roth_contrib_balance', roth_contrib[..., t], 'roth_contrib_value'),
+                ('roth_withdrawal_balance', w['roth_withdrawal'], 'roth_withdrawal_value'),
+            ):
+                np.add(w[balance], contrib, out=w[balance])
+                np.multiply(w[balance], w['growth'], out=w[balance])
+                period_value(w[balance], t, w[value])
+            np.subtract(w['roth_contrib_value'], w['roth_withdrawal_value'], out=roth)
+            np.clip(roth, 0., None, out=roth)
+            round_2(roth)
+        with _stage(instrumentation, 'inflation'):
+            # The inflation legs compound the year-over-year change in each nominal balance
+            infl_growth = inflation[..., t] + 1
+            for field, balance in (('traditional_balance', 'trad_infl_balance'), ('roth_balance', 'roth_infl_balance')):
+                if t > 0:
+                    np.subtract(out[field][..., t, :], out[field][..., t - 1, :], out=w['change'])
+                else:
+                    w['change'][...] = out[field][..., t, :]
+                np.add(w[balance], w['change'], out=w[balance])
+                np.multiply(w[balance], infl_growth, out=w[balance])
+                real = out[f'{field}_real'][..., t, :]
+                np.clip(w[balance], 0., None, out=real)
+                round_2(real)
+        with _stage(instrumentation, 'assembly'):
+            out['traditional_withdrawals'][..., t, :] = w['trad_rmd']
+            out['roth_withdrawals'][..., t, :] = w['roth_withdrawal']
+    return out
+
+
+def simulate_batch(
+        roth_contrib: np.ndarray,
+        trad_contrib: np.ndarray,
+        withdrawal: np.ndarray,
+        allocations: np.ndarray,
+        rates: np.ndarray,
+        rmd_take: np.ndarray,
+        rmd_remain: np.ndarray,
+        tax_rate: float,
+        inflation: Optional[Union[float, np.ndarray]] = None,
+        chunk_size: int = 4_096,
+        instrumentation: Optional[Instrumentation] = None,
+        fused: bool = True,
+        round_each_step: bool = True,
+        out: Optional[Dict[str, np.ndarray]] = None,
+        workspace: Optional[Dict[str, np.ndarray]] = None,
+) -> Dict[str, np.ndarray]:
+    # allocations is either one strategy (years, assets) or a stack (n_strategies, years, assets) that is
+    # broadcast against the same return paths; results are (years, n_sims) or (n_strategies, years, n_sims),
+    # written into out when given
+    n_sims, n_years = rates.shape[:2]
+    strategy_shape = allocations.shape[:-2]
+    results = out
+    if results is None:
+        results = {field: np.empty(strategy_shape + (n_years, n_sims)) for field in RESULT_FIELDS}
+    if fused:
+        simulate_fused(
+            roth_contrib=roth_contrib,
+            trad_contrib=trad_contrib,
+            withdrawal=withdrawal,
+            allocations=allocations,
+            rates=rates,
+            rmd_take=rmd_take,
+            rmd_remain=rmd_remain,
+            tax_rate=tax_rate,
+            inflation=inflation,
+            out=results,
+            workspace=workspace,
+            round_each_step=round_each_step,
+            instrumentation=instrumentation,
+        )
+    else:
+        # Paths go through simulate a chunk at a time, to bound the size of the intermediate arrays
+        chunk_size = max(1, chunk_size // int(np.prod(strategy_shape)))
+        for start in range(0, n_sims, chunk_size):
+            stop = min(start + chunk_size, n_sims)
+            outputs = simulate(
+                roth_contrib=roth_contrib,
+                trad_contrib=trad_contrib,
+                withdrawal=withdrawal,
+                allocations=np.expand_dims(allocations, axis=-3),
+                rates=rates[start:stop],
+                rmd_take=rmd_take,
+                rmd_remain=rmd_remain,
+                tax_rate=tax_rate,
+                inflation=inflation,
+                instrumentation=instrumentation,
+            )
+            with _stage(instrumentation, 'assembly'):
+                for field, arr in zip(RESULT_FIELDS, (arr for pair in outputs for arr in pair)):
+                    results[field][..., start:stop] = np.swapaxes(arr, -1, -2)
+    with _stage(instrumentation, 'assembly'):
+        for arr in results.values():
+            arr.round(out=arr)
+    return results
+
+
+def compute_shortfall(roth_withdrawals: np.ndarray, roth_balance: np.ndarray, retired: np.ndarray) -> np.ndarray:
+    # Paths that could not fund their withdrawal in some retired year. Withdrawals come out of the Roth leg
+    # (the traditional leg only pays out its RMD, a fraction of its balance, so it never runs dry), so money
+    # runs out when a Roth withdrawal is due with the Roth balance at zero. The balances are (..., years,
+    # n_sims) and retired is (..., years); returns (..., n_sims).
+    unmet = (roth_withdrawals > 0) & (roth_balance <= 0)
+    return (unmet & retired[..., None]).any(axis=-2)
+
+
+def simulation_inputs(
+    ret: Retiree,
+    ret_df: 'pd.DataFrame',
+    start_age: int,
+    end_age: int,
+) -> Dict[str, Union[float, np.ndarray]]:
+    # ret_df can also be a dict of column arrays, e.g. one retiree's row of make_ret_arrays
+    rmd_t, rmd_r = calc_rmd(ret)
+    return dict(
+        roth_contrib=np.asarray(ret_df['total_roth_dep'])[start_age: end_age+1],
+        trad_contrib=np.asarray(ret_df['total_trad_dep'])[start_age: end_age+1],
+        withdrawal=np.asarray(ret_df['with'])[start_age: end_age+1],
+        rmd_take=rmd_t[start_age: end_age+1],
+        rmd_remain=rmd_r[start_age: end_age+1],
+        tax_rate=ret.effective_tax_rate,
+        inflation=ret.inflation_arr[start_age: end_age+1],
+    )
+
+
+def _shard_generators(rng, n_shards: int, shard_size: int) -> List:
+    if not (isinstance(rng, HistoricalInputs) and rng.bootstrap is None):
+        return rng.spawn(n_shards)
+    # Historical windows are deterministic, so they are sharded by offsetting into the sequence of windows
+    shards = []
+    for i in range(n_shards):
+        shard = copy.copy(rng)
+        shard.pointer = i * shard_size
+        shards.append(shard)
+    return shards
+
+
+def _rng_fingerprint(rng) -> Optional[tuple]:
+    # Unseeded generators cannot reproduce their draws, so their results are never cached
+    deterministic = isinstance(rng, HistoricalInputs) and rng.bootstrap is None
+    if rng.seed is None and not deterministic:
+        return None
+    config = {f.name: getattr(rng, f.name) for f in dataclasses.fields(rng)}
+    config['historical_data'] = getattr(rng, 'historical_data', None)
+    return type(rng).__name__, config
+
+
+def _draws_depend_on_chunking(rng) -> bool:
+    # Sobol and stratified draws are randomized per generate_batch call, antithetic pairs are formed within
+    # a call, and a bootstrap call draws block lengths and starts as separate arrays, so splitting a batch
+    # into chunks changes these paths
+    if isinstance(rng, HistoricalInputs):
+        return rng.bootstrap is not None
+    return getattr(rng, 'sampling', 'random') != 'random'
+
+
+def _map_shards(
+    func: Callable,
+    rng,
+    n_sims: int,
+    shard_size: int,
+    workers: int,
+    *args,
+) -> Iterator:
+    # Each shard of paths draws from its own child stream, so results depend on the seed and
+    # shard_size but not on the number of workers
+    shard_sims = [min(shard_size, n_sims - i) for i in range(0, n_sims, shard_size)]
+    shard_args = (
+        _shard_generators(rng, len(shard_sims), shard_size),
+        shard_sims,
+    ) + tuple([arg] * len(shard_sims) for arg in args)
+    if workers == 1:
+        yield from map(func, *shard_args)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(func, *shard_args)
+
+
+def _run_shard(
+    rng,
+    n_sims: int,
+    n_years: int,
+    allocations: np.ndarray,
+    inputs: Dict[str, Union[float, np.ndarray]],
+    instrumentation: Optional[Instrumentation] = None,
+) -> Dict[str, np.ndarray]:
+    with _stage(instrumentation, 'rng'):
+        rates = rng.generate_batch(n_sims, n_years)
+    return simulate_batch(
         allocations=allocations,
         rates=rates,
-    ).sum(axis=1).round(2)), 0.0, None).round(2)
-    
-    roth_infl = compute_period_returns(
-        contributions=np.diff(roth, prepend=0).flatten(),
-        allocations=np.ones_like(roth.reshape((-1,1))),
-        rates=inflation.reshape((-1,1)),
-    ).sum(axis=1).round(2)
-    
-    return (trad, roth), (trad_infl, roth_infl), (trad_rmd, roth_withdrawal)
+        instrumentation=instrumentation,
+        **inputs,
+    )
 
 
-from collections import defaultdict
+def _run_instrumented_shard(
+    rng,
+    n_sims: int,
+    n_years: int,
+    allocations: np.ndarray,
+    inputs: Dict[str, Union[float, np.ndarray]],
+    instrumentation: Instrumentation,
+) -> tuple:
+    # Runs in the worker, so the shard's stage counters are sent back alongside its results
+    instrumentation.start_run()
+    results = _run_shard(rng, n_sims, n_years, allocations, inputs, instrumentation)
+    instrumentation.finish_run()
+    return results, instrumentation.stats
+
+
+def _merge_shard_stats(instrumentation: Instrumentation, shards: Iterator[tuple]) -> Iterator[Dict[str, np.ndarray]]:
+    # Stage times are summed over shards, so with several workers they can exceed the wall time
+    for results, shard_stats in shards:
+        instrumentation.stats.merge(shard_stats)
+        yield results
+
+
+def _iter_chunks(
+    rng,
+    n_sims: int,
+    n_years: int,
+    allocations: np.ndarray,
+    inputs: Dict[str, Union[float, np.ndarray]],
+    chunk_size: int,
+    instrumentation: Optional[Instrumentation] = None,
+) -> Iterator[Dict[str, np.ndarray]]:
+    # With random sampling (and historical windows), consecutive generate_batch calls continue the same
+    # stream, so chunking does not change the paths; other sampling modes and the bootstraps depend on
+    # chunk_size (see _draws_depend_on_chunking).
+    # Rates, results and workspace buffers are reused by every chunk, so each result must be consumed
+    # before the next one is requested.
+    max_chunk = min(chunk_size, n_sims)
+    rates_buffer = np.empty((max_chunk, n_years, allocations.shape[-1]))
+    results_buffer = {field: np.empty(allocations.shape[:-2] + (n_years, max_chunk)) for field in RESULT_FIELDS}
+    workspace = make_workspace(allocations.shape[:-2] + (max_chunk,), n_years, allocations.shape[-1])
+    for start in range(0, n_sims, chunk_size):
+        n_chunk = min(chunk_size, n_sims - start)
+        with _stage(instrumentation, 'rng'):
+            rates = rng.generate_batch(n_chunk, n_years, out=rates_buffer[:n_chunk])
+        yield simulate_batch(
+            allocations=allocations,
+            rates=rates,
+            instrumentation=instrumentation,
+            out={field: arr[..., :n_chunk] for field, arr in results_buffer.items()},
+            workspace={name: arr[..., :n_chunk] for name, arr in workspace.items()},
+            **inputs,
+        )
+
+
+def _summarize_shard(
+    rng,
+    n_sims: int,
+    n_years: int,
+    allocations: np.ndarray,
+    inputs: Dict[str, Union[float, np.ndarray]],
+    chunk_size: int,
+    summary_kwargs: Dict[str, float],
+) -> List[Dict[str, YearlySummary]]:
+    summaries = [
+        {field: YearlySummary(n_years, **summary_kwargs) for field in SUMMARY_FIELDS}
+        for _ in range(allocations.shape[0])
+    ]
+    for results in _iter_chunks(rng, n_sims, n_years, allocations, inputs, chunk_size):
+        results['portfolio_balance'] = results['traditional_balance'] + results['roth_balance']
+        results['portfolio_balance_real'] = results['traditional_balance_real'] + results['roth_balance_real']
+        for i, strat_summaries in enumerate(summaries):
+            for field, summary in strat_summaries.items():
+                summary.update(results[field][i])
+    return summaries
+
 
 def run_simulations(
     ret: Retiree,
-    ret_df: pd.DataFrame,
+    ret_df: 'pd.DataFrame',
     allocation_strats: Dict[str, np.ndarray],
     rng: ParametricOptimizationInputs,
     start_age: Optional[int] = None,
     end_age: Optional[int] = None,
     n_sims: int = 10_000,
+    workers: Optional[int] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    run_dir: Optional[str] = None,
+    cache: Optional[ResultCache] = None,
+    instrumentation: Optional[Instrumentation] = None,
 ) -> Dict[str, np.ndarray]:
     result_dict = defaultdict(dict)
-    rmd_t, rmd_r = calc_rmd(ret)
     if start_age is None:
         start_age = ret.age
     if end_age is None:
         end_age = ret.retirement_age
+    inputs = simulation_inputs(ret, ret_df, start_age, end_age)
 
     start_time = time.time()
+    if instrumentation is not None:
+        instrumentation.start_run()
     
-        
-    for key, astrat in allocation_strats.items():   
+    # Every strategy is evaluated against the same return paths (common random numbers)
+    keys = list(allocation_strats.keys())
+
+    # With common random numbers a strategy's results depend only on its own allocations and the
+    # shared inputs, so each strategy is cached separately and only the misses are simulated
+    cache_keys = dict()
+    rng_fingerprint = _rng_fingerprint(rng)
+    if cache is not None and run_dir is not None:
+        raise ValueError('cache and run_dir cannot be used together')
+    if cache is not None and rng_fingerprint is not None:
+        for key in keys:
+            cache_keys[key] = cache.make_key(
+                inputs,
+                allocation_strats[key][start_age: end_age+1],
+                rng_fingerprint,
+                start_age,
+                end_age,
+                n_sims,
+                None if workers is None else shard_size,
+                chunk_size if workers is None and _draws_depend_on_chunking(rng) else None,
+            )
+            cached = cache.get(cache_keys[key])
+            if cached is not None:
+                result_dict[key] = cached
+        keys = [key for key in keys if key not in result_dict]
+
+    n_years = end_age - start_age + 1
+    sim_time = 0.
+    if keys:
+        sim_start_time = time.perf_counter()
+        allocations = np.stack([allocation_strats[key][start_age: end_age+1] for key in keys])
         rng.reset()
-        traditional_balance_list = []
-        roth_balance_list = []
-        traditional_balance_real_list = []
-        roth_balance_real_list = []
-        traditional_withdrawals_list = []
-        roth_withdrawals_list = []
-        for _ in range(n_sims):
-            r = rng.generate_normal(end_age - start_age + 1)
-            (
-                (traditional_balance, roth_balance),
-                (traditional_balance_real, roth_balance_real),
-                (traditional_withdrawals, roth_withdrawals)
-            ) = simulate(
-                roth_contrib=ret_df['total_roth_dep'].values[start_age: end_age+1],
-                trad_contrib=ret_df['total_trad_dep'].values[start_age: end_age+1],
-                withdrawal=ret_df['with'].values[start_age: end_age+1],
-                allocations=astrat[start_age: end_age+1],
-                rates=r,
-                rmd_take=rmd_t[start_age: end_age+1],
-                rmd_remain=rmd_r[start_age: end_age+1],
-                tax_rate=ret.effective_tax_rate,
-                inflation=ret.inflation_arr[start_age: end_age+1],
+        if workers is None:
+            chunks = _iter_chunks(rng, n_sims, n_years, allocations, inputs, chunk_size, instrumentation)
+        elif instrumentation is None:
+            chunks = _map_shards(_run_shard, rng, n_sims, shard_size, workers, n_years, allocations, inputs)
+        else:
+            chunks = _merge_shard_stats(instrumentation, _map_shards(
+                _run_instrumented_shard, rng, n_sims, shard_size, workers,
+                n_years, allocations, inputs, instrumentation.child(),
+            ))
+        # Results are written a chunk at a time, either into memory or into memory-mapped .npy files
+        if run_dir is None:
+            arrays = {key: {field: np.empty((n_years, n_sims)) for field in RESULT_FIELDS} for key in keys}
+        else:
+            arrays = create_result_arrays(
+                run_dir, keys, RESULT_FIELDS, n_years, n_sims,
+                metadata=dict(start_age=start_age, end_age=end_age),
             )
-            
-            traditional_balance_list.append(traditional_balance)
-            roth_balance_list.append(roth_balance)
-            traditional_balance_real_list.append(traditional_balance_real)
-            roth_balance_real_list.append(roth_balance_real)
-            traditional_withdrawals_list.append(traditional_withdrawals)
-            roth_withdrawals_list.append(roth_withdrawals)
-            
-            
-
-        result_dict[key]['traditional_balance'] =  np.column_stack(traditional_balance_list).round()
-        result_dict[key]['roth_balance'] =  np.column_stack(roth_balance_list).round()
-        result_dict[key]['traditional_balance_real'] =  np.column_stack(traditional_balance_real_list).round()
-        result_dict[key]['roth_balance_real'] =  np.column_stack(roth_balance_real_list).round()
-        result_dict[key]['traditional_withdrawals'] =  np.column_stack(traditional_withdrawals_list).round()
-        result_dict[key]['roth_withdrawals'] =  np.column_stack(roth_withdrawals_list).round()
+        start = 0
+        for results in chunks:
+            stop = start + results[RESULT_FIELDS[0]].shape[-1]
+            with _stage(instrumentation, 'assembly'):
+                for i, key in enumerate(keys):
+                    for field in RESULT_FIELDS:
+                        arrays[key][field][:, start:stop] = results[field][i]
+            start = stop
+        with _stage(instrumentation, 'assembly'):
+            if run_dir is not None:
+                close_result_arrays(run_dir, arrays)
+                arrays = load_results(run_dir)
+            result_dict.update(arrays)
+            for key in keys:
+                if key in cache_keys:
+                    cache.put(cache_keys[key], arrays[key])
+        sim_time = time.perf_counter() - sim_start_time
+    result_dict = defaultdict(dict, {key: result_dict[key] for key in allocation_strats})
     
     total_time =  time.time() - start_time
+    if instrumentation is not None:
+        # Strategies share the same paths, so each simulated strategy is credited with the joint run time
+        instrumentation.stats.n_sims = n_sims
+        instrumentation.stats.n_years = n_years
+        instrumentation.stats.strategies = {
+            key: StrategyStats(n_sims, sim_time if key in keys else 0., cached=key not in keys)
+            for key in allocation_strats
+        }
+        instrumentation.finish_run(total_time)
     
+    print(f'Done. {n_sims * len(keys):,} simulations of {end_age - start_age:,} years took {total_time:0.2f}s')
+    return result_dict
+
+
+def summarize_simulations(
+    ret: Retiree,
+    ret_df: 'pd.DataFrame',
+    allocation_strats: Dict[str, np.ndarray],
+    rng: ParametricOptimizationInputs,
+    start_age: Optional[int] = None,
+    end_age: Optional[int] = None,
+    n_sims: int = 10_000,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: Optional[int] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    **summary_kwargs,
+) -> Dict[str, Dict[str, YearlySummary]]:
+    # Same paths as run_simulations, but only mergeable per-year statistics are kept, so memory
+    # depends on chunk_size rather than n_sims
+    result_dict = defaultdict(dict)
+    if start_age is None:
+        start_age = ret.age
+    if end_age is None:
+        end_age = ret.retirement_age
+    inputs = simulation_inputs(ret, ret_df, start_age, end_age)
+
+    start_time = time.time()
+
+    keys = list(allocation_strats.keys())
+    if keys:
+        n_years = end_age - start_age + 1
+        allocations = np.stack([allocation_strats[key][start_age: end_age+1] for key in keys])
+        rng.reset()
+        if workers is None:
+            summaries = _summarize_shard(rng, n_sims, n_years, allocations, inputs, chunk_size, summary_kwargs)
+        else:
+            summaries = None
+            for shard_summaries in _map_shards(
+                _summarize_shard, rng, n_sims, shard_size, workers,
+                n_years, allocations, inputs, chunk_size, summary_kwargs,
+            ):
+                if summaries is None:
+                    summaries = shard_summaries
+                    continue
+                for strat_summaries, strat_shard_summaries in zip(summaries, shard_summaries):
+                    for field, summary in strat_summaries.items():
+                        summary.merge(strat_shard_summaries[field])
+        for key, strat_summaries in zip(keys, summaries):
+            result_dict[key] = strat_summaries
+
+    total_time =  time.time() - start_time
+
+    print(f'Done. {n_sims * len(allocation_strats):,} simulations of {end_age - start_age:,} years took {total_time:0.2f}s')
+    return result_dict
+
+
+def _simulation_progress(
+    summaries: Dict[str, Dict[str, YearlySummary]],
+    n_done: int,
+    n_sims: int,
+    seconds: float,
+    percentiles: Sequence[float],
+    bins: Union[int, np.ndarray],
+) -> SimulationProgress:
+    # Histogram edges are shared by all strategies so they can be compared, but not across fields
+    fields = list(next(iter(summaries.values())))
+    bin_edges = dict()
+    for field in fields:
+        if np.ndim(bins):
+            bin_edges[field] = np.asarray(bins)
+            continue
+        low = min(strat_summaries[field].min[-1] for strat_summaries in summaries.values())
+        high = max(strat_summaries[field].max[-1] for strat_summaries in summaries.values())
+        bin_edges[field] = np.linspace(low, max(high, low + 1.), bins + 1)
+    return SimulationProgress(
+        n_done=n_done,
+        n_sims=n_sims,
+        seconds=seconds,
+        percentiles=percentiles,
+        quantiles={
+            key: {field: summary.quantile(np.asarray(percentiles) / 100) for field, summary in strat_summaries.items()}
+            for key, strat_summaries in summaries.items()
+        },
+        bin_edges=bin_edges,
+        ending_histograms={
+            key: {field: summary.histogram(bin_edges[field]) for field, summary in strat_summaries.items()}
+            for key, strat_summaries in summaries.items()
+        },
+        summaries=summaries,
+    )
+
+
+def iter_simulations(
+    ret: Retiree,
+    ret_df: 'pd.DataFrame',
+    allocation_strats: Dict[str, np.ndarray],
+    rng: ParametricOptimizationInputs,
+    start_age: Optional[int] = None,
+    end_age: Optional[int] = None,
+    n_sims: int = 10_000,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: Optional[int] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    percentiles: Sequence[float] = (5, 25, 50, 75, 95),
+    bins: Union[int, np.ndarray] = 50,
+    fields: Sequence[str] = ('portfolio_balance', 'portfolio_balance_real'),
+    **summary_kwargs,
+) -> Iterator[SimulationProgress]:
+    # summarize_simulations that yields a SimulationProgress after every chunk (or shard, with workers), so
+    # callers can update plots, report progress or stop early. Once all paths are done the summaries are
+    # those summarize_simulations returns for the same chunk_size or shard_size.
+    unknown = set(fields) - set(SUMMARY_FIELDS)
+    if unknown:
+        raise ValueError(f'Cannot summarize {sorted(unknown)}: fields must be in {SUMMARY_FIELDS}')
+    if start_age is None:
+        start_age = ret.age
+    if end_age is None:
+        end_age = ret.retirement_age
+    inputs = simulation_inputs(ret, ret_df, start_age, end_age)
+
+    start_time = time.time()
+
+    keys = list(allocation_strats.keys())
+    if not keys:
+        return
+    n_years = end_age - start_age + 1
+    allocations = np.stack([allocation_strats[key][start_age: end_age+1] for key in keys])
+    summaries = {key: {field: YearlySummary(n_years, **summary_kwargs) for field in fields} for key in keys}
+    n_done = 0
+    rng.reset()
+    if workers is None:
+        for results in _iter_chunks(rng, n_sims, n_years, allocations, inputs, chunk_size):
+            results['portfolio_balance'] = results['traditional_balance'] + results['roth_balance']
+            results['portfolio_balance_real'] = results['traditional_balance_real'] + results['roth_balance_real']
+            for i, key in enumerate(keys):
+                for field, summary in summaries[key].items():
+                    summary.update(results[field][i])
+            n_done += results[fields[0]].shape[-1]
+            yield _simulation_progress(summaries, n_done, n_sims, time.time() - start_time, percentiles, bins)
+    else:
+        for shard_summaries in _map_shards(
+            _summarize_shard, rng, n_sims, shard_size, workers,
+            n_years, allocations, inputs, chunk_size, summary_kwargs,
+        ):
+            for key, strat_shard_summaries in zip(keys, shard_summaries):
+                for field, summary in summaries[key].items():
+                    summary.merge(strat_shard_summaries[field])
+            n_done += shard_summaries[0][fields[0]].count
+            yield _simulation_progress(summaries, n_done, n_sims, time.time() - start_time, percentiles, bins)
+
+    total_time =  time.time() - start_time
+
     print(f'Done. {n_sims * len(allocation_strats):,} simulations of {end_age - start_age:,} years took {total_time:0.2f}s')
-    return result_dict
\ No newline at end of file
+
+
+async def aiter_simulations(*args, **kwargs) -> AsyncIterator[SimulationProgress]:
+    # iter_simulations as an async iterator. Chunks run in a worker thread, so the event loop stays responsive;
+    # leaving the loop (break or cancellation) stops after the chunk in progress.
+    progress = iter_simulations(*args, **kwargs)
+    finished = object()
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            update = await asyncio.wrap_future(executor.submit(next, progress, finished))
+            if update is finished:
+                break
+            yield update
+    finally:
+        # Queued behind any chunk still running, since the generator cannot be closed while it executes
+        executor.submit(progress.close)
+        executor.shutdown(wait=False)
+
+
+def run_adaptive_simulations(
+    ret: Retiree,
+    ret_df: 'pd.DataFrame',
+    allocation_strats: Dict[str, np.ndarray],
+    rng: ParametricOptimizationInputs,
+    start_age: Optional[int] = None,
+    end_age: Optional[int] = None,
+    median_rtol: Optional[float] = 0.01,
+    shortfall_atol: Optional[float] = 0.005,
+    confidence: float = 0.95,
+    batch_size: int = 1_000,
+    min_batches: int = 10,
+    max_sims: int = 100_000,
+    real: bool = True,
+) -> 'pd.DataFrame':
+    # Simulates batches of paths until, for every strategy, the confidence interval of the median ending
+    # balance is within median_rtol of the median and that of the shortfall probability (a withdrawal left
+    # unmet after retirement, see compute_shortfall) is within shortfall_atol, or max_sims paths have been used. Converged
+    # strategies stop while the rest continue on the same stream, so all strategies still share their paths.
+    import pandas as pd
+
+    if start_age is None:
+        start_age = ret.age
+    if end_age is None:
+        end_age = ret.life_expectancy
+    inputs = simulation_inputs(ret, ret_df, start_age, end_age)
+    n_years = end_age - start_age + 1
+    retired = ret.ages_arr[start_age: end_age+1] > ret.retirement_age
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    suffix = '_real' if real else ''
+    median = percentile_statistic(50)
+
+    start_time = time.time()
+
+    keys = list(allocation_strats.keys())
+    allocations = np.stack([allocation_strats[key][start_age: end_age+1] for key in keys])
+    ending = [[] for _ in keys]
+    shortfall = [[] for _ in keys]
+    stats = [dict(n_sims=0, converged=False) for _ in keys]
+    alive = np.arange(len(keys))
+    n_done = 0
+    rng.reset()
+    while alive.size and n_done < max_sims:
+        n_batch = min(batch_size, max_sims - n_done)
+        results = simulate_batch(
+            allocations=allocations[alive],
+            rates=rng.generate_batch(n_batch, n_years),
+            **inputs,
+        )
+        portfolio_ending = (results[f'traditional_balance{suffix}'] + results[f'roth_balance{suffix}'])[:, -1]
+        depleted = compute_shortfall(results['roth_withdrawals'], results['roth_balance'], retired)
+        n_done += n_batch
+
+        converged = np.zeros(alive.size, dtype=bool)
+        for i, k in enumerate(alive):
+            ending[k].append(portfolio_ending[i])
+            shortfall[k].append(depleted[i].astype(float))
+            stats[k]['n_sims'] = n_done
+            if len(ending[k]) < max(min_batches, 2):
+                continue
+            med, med_se = standard_error(np.concatenate(ending[k]), median, batch_size)
+            prob, prob_se = standard_error(np.concatenate(shortfall[k]), mean_statistic, batch_size)
+            stats[k].update(
+                median=med,
+                median_ci_low=med - z * med_se,
+                median_ci_high=med + z * med_se,
+                shortfall_probability=prob,
+                shortfall_ci_low=max(prob - z * prob_se, 0.),
+                shortfall_ci_high=min(prob + z * prob_se, 1.),
+            )
+            stats[k]['converged'] = converged[i] = (
+                (median_rtol is None or z * med_se <= median_rtol * abs(med))
+                and (shortfall_atol is None or z * prob_se <= shortfall_atol)
+            )
+        alive = alive[~converged]
+
+    total_time = time.time() - start_time
+
+    n_total = sum(strat_stats['n_sims'] for strat_stats in stats)
+    print(f'Done. {n_total:,} simulations of {end_age - start_age:,} years '
+          f'took {total_time:0.2f}s')
+    return pd.DataFrame(stats, index=keys)
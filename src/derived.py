@@ -0,0 +1,98 @@
+from collections import defaultdict
+from typing import Callable, Dict, List, Set
+import weakref
+
+
+class derived:
+    # A memoized attribute computed on first access. depends_on names the fields and derived attributes it is
+    # computed from, or 'attr.name' for an attribute of a DependencyTracked object held in attr
+    # (e.g. 'retiree.income_arr'). Assigning to it overrides the value until a dependency changes.
+    def __init__(self, *depends_on: str):
+        self.depends_on = depends_on
+
+    def __call__(self, func: Callable) -> 'derived':
+        self.func = func
+        self.__doc__ = func.__doc__
+        return self
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        cache = obj.__dict__.setdefault('_derived_cache', dict())
+        if self.name not in cache:
+            cache[self.name] = self.func(obj)
+        return cache[self.name]
+
+    def __set__(self, obj, value):
+        obj.__dict__.setdefault('_derived_cache', dict())[self.name] = value
+
+
+class DependencyTracked:
+    # Mixin that drops memoized derived attributes when an attribute they depend on is assigned, and
+    # forwards the change to objects holding this one
+
+    @classmethod
+    def _dependency_graph(cls) -> Dict[str, Set[str]]:
+        # name -> derived attributes that depend on it directly
+        if '_graph' not in cls.__dict__:
+            graph = defaultdict(set)
+            for klass in reversed(cls.__mro__):
+                for name, attr in vars(klass).items():
+                    if isinstance(attr, derived):
+                        for dependency in attr.depends_on:
+                            graph[dependency].add(name)
+            cls._graph = dict(graph)
+        return cls.__dict__['_graph']
+
+    def invalidate(self, *names: str) -> Set[str]:
+        # Drops every derived attribute depending, directly or not, on names; returns the dropped names
+        graph = self._dependency_graph()
+        stale = set()
+        pending = list(names)
+        while pending:
+            for dependent in graph.get(pending.pop(), ()):
+                if dependent not in stale:
+                    stale.add(dependent)
+                    pending.append(dependent)
+        cache = self.__dict__.get('_derived_cache')
+        if cache:
+            for name in stale:
+                cache.pop(name, None)
+        holders = []
+        for ref, attr in self.__dict__.get('_holders', ()):
+            holder = ref()
+            if holder is not None and getattr(holder, attr, None) is self:
+                holders.append((ref, attr))
+                holder.invalidate(*(f'{attr}.{name}' for name in set(names) | stale))
+        self.__dict__['_holders'] = holders
+        return stale
+
+    def _held_dependencies(self, name: str) -> List[str]:
+        prefix = f'{name}.'
+        return [dependency for dependency in self._dependency_graph() if dependency.startswith(prefix)]
+
+    def _hold(self, name: str):
+        # Registers with the DependencyTracked object in attribute name, so its changes reach this one
+        value = self.__dict__.get(name)
+        if isinstance(value, DependencyTracked):
+            value.__dict__.setdefault('_holders', []).append((weakref.ref(self), name))
+
+    def __setattr__(self, name: str, value):
+        object.__setattr__(self, name, value)
+        held = self._held_dependencies(name)
+        if held:
+            self._hold(name)
+        self.invalidate(name, *held)
+
+    def __getstate__(self):
+        # Memoized values and holder references are rebuilt on demand
+        return {k: v for k, v in self.__dict__.items() if k not in ('_derived_cache', '_holders')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in list(state):
+            if self._held_dependencies(name):
+                self._hold(name)
@@ -0,0 +1,57 @@
+from typing import Callable, Dict, Sequence, Tuple
+
+
+import numpy as np
+
+
+def percentile_statistic(q: float) -> Callable[[np.ndarray], np.ndarray]:
+    def statistic(values: np.ndarray) -> np.ndarray:
+        return np.percentile(values, q, axis=-1)
+    return statistic
+
+
+def mean_statistic(values: np.ndarray) -> np.ndarray:
+    return values.mean(axis=-1)
+
+
+def batch_estimates(values: np.ndarray, statistic: Callable[[np.ndarray], np.ndarray], batch_size: int) -> np.ndarray:
+    # statistic of each consecutive batch of paths along the last axis, stacked on a new leading axis. The
+    # last batch absorbs any remainder.
+    n_batches = max(1, values.shape[-1] // batch_size)
+    bounds = np.arange(1, n_batches) * batch_size
+    return np.stack([statistic(batch) for batch in np.split(values, bounds, axis=-1)])
+
+
+def standard_error(
+    values: np.ndarray,
+    statistic: Callable[[np.ndarray], np.ndarray],
+    batch_size: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # The statistic over all paths, and its standard error from the spread of per-batch estimates. Batches
+    # must be independent randomizations, which holds when batch_size matches the chunk_size (or shard_size)
+    # the paths were generated with, whatever the sampling mode.
+    estimates = batch_estimates(values, statistic, batch_size)
+    if estimates.shape[0] < 2:
+        raise ValueError('Standard errors need at least two batches of paths')
+    return statistic(values), estimates.std(axis=0, ddof=1) / np.sqrt(estimates.shape[0])
+
+
+def estimate_ending_balances(
+    simulation_results: Dict[str, Dict[str, np.ndarray]],
+    batch_size: int,
+    percentiles: Sequence[float] = (5, 50, 95),
+    real: bool = True,
+):
+    # Percentiles and mean of the ending portfolio balance for each strategy of run_simulations, each with
+    # its standard error
+    import pandas as pd
+
+    suffix = '_real' if real else ''
+    rows = dict()
+    for key, results in simulation_results.items():
+        ending = (results[f'traditional_balance{suffix}'] + results[f'roth_balance{suffix}'])[-1]
+        row = dict()
+        for name, statistic in [('mean', mean_statistic)] + [(f'p{q:g}', percentile_statistic(q)) for q in percentiles]:
+            row[name], row[f'{name}_se'] = standard_error(ending, statistic, batch_size)
+        rows[key] = row
+    return pd.DataFrame.from_dict(rows, orient='index')
@@ -1,11 +1,27 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 import copy
-from typing import List, Optional
+import hashlib
+import json
+import os
+import warnings
+from typing import List, Optional, Tuple, Union
 
 
 import numpy as np
 from numpy.random import PCG64
-import pandas as pd
+
+
+HISTORICAL_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'historical')
+HISTORICAL_COLUMNS = ['year', 'stocks', 'bonds', 'bills']
+SAMPLING_MODES = ('random', 'antithetic', 'sobol', 'stratified')
+
+
+def _inverse_normal_cdf(u: np.ndarray) -> np.ndarray:
+    try:
+        from scipy.special import ndtri
+    except ImportError as e:
+        raise ImportError('sobol and stratified sampling require scipy') from e
+    return ndtri(u)
 
 
 @dataclass(frozen=True)
@@ -20,27 +36,134 @@ class ParametricOptimizationInputs:
         [0.08, 1.0, 0.71],
         [0.09, 0.71, 1.0]])))
     cov_matrix: np.ndarray = field(init=False, repr=False)
-    seed: Optional[int] = field(default=None, repr=False)
+    seed: Optional[Union[int, np.random.SeedSequence]] = field(default=None, repr=False)
     cash_negative: bool = False
+    sampling: str = 'random'
         
     def __post_init__(self):
+        if self.sampling not in SAMPLING_MODES:
+            raise ValueError(f'sampling must be one of {SAMPLING_MODES}')
         object.__setattr__(self, 'means', self.arithmetic_means)
         object.__setattr__(self, 'cov_matrix', np.outer(self.stds, self.stds) * self.corr_matrix)
+        object.__setattr__(self, '_cov_factor', self._factor_cov_matrix(self.cov_matrix))
         object.__setattr__(self, '_rand_gen', np.random.Generator(PCG64(self.seed)))
+
+    @staticmethod
+    def _factor_cov_matrix(cov_matrix: np.ndarray) -> np.ndarray:
+        # Upper factor F with F.T @ F == cov_matrix, so that standard normals z @ F have covariance cov_matrix
+        try:
+            return np.linalg.cholesky(cov_matrix).T
+        except np.linalg.LinAlgError:
+            # Semi-definite covariance: fall back to the SVD factor used by Generator.multivariate_normal
+            _, s, vh = np.linalg.svd(cov_matrix)
+            return np.sqrt(s)[:, None] * vh
         
     def generate_normal(self, size: int = 30) -> np.ndarray:
-        r = self._rand_gen.multivariate_normal(
-            mean=self.means,
-            cov=self.cov_matrix,
-            size=size,
-        )
+        return self.generate_batch(1, size)[0]
+
+    def generate_batch(self, n_sims: int, size: int = 30, out: Optional[np.ndarray] = None) -> np.ndarray:
+        shape = (n_sims, size, self.means.shape[0])
+        if out is None:
+            out = np.empty(shape)
+        elif out.shape != shape:
+            raise ValueError(f'Expected an output buffer of shape {shape}, got {out.shape}')
+        self._standard_normal(out)
+        out[...] = out @ self._cov_factor
+        out += self.means
         if not self.cash_negative:
-            r[:,2] = np.clip(r[:,2], 0, 1)
-        return r
+            np.clip(out[..., 2], 0, 1, out=out[..., 2])
+        return out
+
+    def _standard_normal(self, out: np.ndarray):
+        # Fills out (n_sims, size, n_assets) with standard normals. Every call is an independent
+        # randomization (antithetic pairs, strata and Sobol scrambles never span calls), so statistics of
+        # separate batches can be used as replicates for standard errors.
+        n_sims = out.shape[0]
+        if self.sampling == 'random':
+            self._rand_gen.standard_normal(out=out)
+        elif self.sampling == 'antithetic':
+            # Consecutive paths are mirrored pairs; an odd last path is left unpaired
+            z = self._rand_gen.standard_normal((n_sims - n_sims // 2,) + out.shape[1:])
+            out[0::2] = z
+            np.negative(z[:n_sims // 2], out=out[1::2])
+        elif self.sampling == 'sobol':
+            from scipy.stats import qmc
+
+            try:
+                engine = qmc.Sobol(int(np.prod(out.shape[1:])), scramble=True, rng=self._rand_gen)
+            except TypeError:
+                # scipy < 1.15 takes the generator as seed
+                engine = qmc.Sobol(int(np.prod(out.shape[1:])), scramble=True, seed=self._rand_gen)
+            with warnings.catch_warnings():
+                # Batches that are not a power of two lose some balance but stay unbiased
+                warnings.simplefilter('ignore', UserWarning)
+                u = engine.random(n_sims)
+            out[...] = _inverse_normal_cdf(u).reshape(out.shape)
+        else:
+            # One stratum per path for the first normal, which with the Cholesky factor drives the
+            # first-year stock return on its own
+            self._rand_gen.standard_normal(out=out)
+            strata = self._rand_gen.permutation(n_sims) + self._rand_gen.random(n_sims)
+            out[:, 0, 0] = _inverse_normal_cdf(strata / n_sims)
 
     def reset(self):
         object.__setattr__(self, '_rand_gen', np.random.Generator(PCG64(self.seed)))
 
+    def spawn(self, n_children: int) -> List['ParametricOptimizationInputs']:
+        # Independent child streams that depend only on the seed and the child index
+        if isinstance(self.seed, np.random.SeedSequence):
+            seed_seq = np.random.SeedSequence(self.seed.entropy, spawn_key=self.seed.spawn_key)
+        else:
+            seed_seq = np.random.SeedSequence(self.seed)
+        return [replace(self, seed=child_seed) for child_seed in seed_seq.spawn(n_children)]
+
+
+def _file_sha256(filepath: str) -> str:
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def import_historical_workbook(
+        filepath: str,
+        sheetname: str,
+        cache_dir: str = HISTORICAL_CACHE_DIR,
+) -> Tuple[str, dict]:
+    # Converts one sheet of the returns workbook into a (n_years, 4) float64 .npy of HISTORICAL_COLUMNS,
+    # keyed by the workbook's content hash, so later loads can memory-map it without parsing Excel
+    source_hash = _file_sha256(filepath)
+    sheet_hash = hashlib.sha256(sheetname.encode()).hexdigest()[:8]
+    data_path = os.path.join(cache_dir, f'{source_hash[:32]}_{sheet_hash}.npy')
+    meta_path = f'{data_path[:-4]}.json'
+    if os.path.exists(data_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            return data_path, json.load(f)
+
+    import pandas as pd
+
+    dataset = pd.read_excel(filepath, sheet_name=sheetname)
+    if 'bills' not in dataset.columns:
+        dataset['bills'] = 0.0
+    data = dataset[HISTORICAL_COLUMNS].values.astype(np.float64)
+    years = data[:, 0]
+    metadata = dict(
+        source=os.path.abspath(filepath),
+        sheetname=sheetname,
+        sha256=source_hash,
+        columns=HISTORICAL_COLUMNS,
+        sorted=bool(np.all(np.diff(years) > 0)),
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{data_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp_path, data_path)
+    with open(meta_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return data_path, metadata
+
 
 @dataclass
 class HistoricalInputs:
@@ -48,21 +171,70 @@ class HistoricalInputs:
     sheetname: str = 'annual real returns'
     start_year: int = 1930
     cycle: bool = False
+    bootstrap: Optional[str] = None
+    block_size: float = 5.
+    seed: Optional[Union[int, np.random.SeedSequence]] = field(default=None, repr=False)
+    cache_dir: str = field(default=HISTORICAL_CACHE_DIR, repr=False)
     def __post_init__(self):
-        dataset = pd.read_excel(self.filepath, sheet_name=self.sheetname)
-        if 'bills' not in dataset.columns:
-            dataset['bills'] = 0.0
-        dataset = dataset[dataset['year'] >= self.start_year]
-        self.years_arr = dataset['year'].values
-        self.historical_data = dataset[['stocks', 'bonds', 'bills']].values
-        self.pointer = 0
+        if self.bootstrap not in (None, 'stationary', 'circular'):
+            raise ValueError(f'Unknown bootstrap method {self.bootstrap}')
+        data_path, metadata = import_historical_workbook(self.filepath, self.sheetname, self.cache_dir)
+        data = np.load(data_path, mmap_mode='r')
+        if metadata['sorted']:
+            data = data[np.searchsorted(data[:, 0], self.start_year):]
+        else:
+            data = data[data[:, 0] >= self.start_year]
+        self.years_arr = data[:, 0].astype(int)
+        self.historical_data = data[:, 1:]
+        self.reset()
         
     def generate_normal(self, size: int = 30) -> np.ndarray:
+        if self.bootstrap is not None:
+            return self.generate_batch(1, size)[0]
         if (self.cycle == False) and (self.pointer + size > self.historical_data.shape[0]):
             raise ValueError('Not enough historical data!')
         r = self.historical_data.take(range(self.pointer, self.pointer+size), mode='wrap', axis=0)
         self.pointer += 1
         return r
+
+    def rolling_windows(self, size: int = 30) -> np.ndarray:
+        # Every window of get_n_sims(size) as a (n_windows, size, n_assets) view; with cycle the data is
+        # first extended by wrapping around so the last windows continue from the start
+        data = self.historical_data
+        if self.cycle:
+            data = data.take(range(data.shape[0] + size - 1), mode='wrap', axis=0)
+        elif size > data.shape[0]:
+            raise ValueError('Not enough historical data!')
+        return np.lib.stride_tricks.sliding_window_view(data, size, axis=0).transpose(0, 2, 1)
+
+    def generate_batch(self, n_sims: int, size: int = 30, out: Optional[np.ndarray] = None) -> np.ndarray:
+        if self.bootstrap is not None:
+            return self.bootstrap_batch(n_sims, size, out=out)
+        if (self.cycle == False) and (self.pointer + n_sims + size - 1 > self.historical_data.shape[0]):
+            raise ValueError('Not enough historical data!')
+        windows = self.rolling_windows(size)
+        r = windows.take(range(self.pointer, self.pointer + n_sims), mode='wrap', axis=0, out=out)
+        self.pointer += n_sims
+        return r
+
+    def bootstrap_batch(self, n_sims: int, size: int = 30, out: Optional[np.ndarray] = None) -> np.ndarray:
+        # Resampled paths built from blocks of consecutive historical years (wrapping around the end).
+        # Stationary (Politis-Romano) blocks have geometric lengths with mean block_size; circular blocks
+        # all have length block_size.
+        n_years = self.historical_data.shape[0]
+        steps = np.arange(size)
+        if self.bootstrap == 'stationary':
+            new_block = self._rand_gen.random((n_sims, size)) < 1 / self.block_size
+            new_block[:, 0] = True
+            block_starts = self._rand_gen.integers(0, n_years, (n_sims, size))
+            # Position of the most recent block start at or before each step
+            start_pos = np.maximum.accumulate(np.where(new_block, steps, 0), axis=1)
+            idxs = np.take_along_axis(block_starts, start_pos, axis=1) + (steps - start_pos)
+        else:
+            block_size = int(self.block_size)
+            block_starts = self._rand_gen.integers(0, n_years, (n_sims, -(-size // block_size)))
+            idxs = block_starts[:, steps // block_size] + steps % block_size
+        return self.historical_data.take(idxs, mode='wrap', axis=0, out=out)
     
     def get_n_sims(self, size: int = 30) -> int:
         if self.cycle == False:
@@ -71,3 +243,18 @@ class HistoricalInputs:
 
     def reset(self):
         self.pointer = 0
+        self._rand_gen = np.random.Generator(PCG64(self.seed))
+
+    def spawn(self, n_children: int) -> List['HistoricalInputs']:
+        # Independent bootstrap streams, as for ParametricOptimizationInputs.spawn
+        if isinstance(self.seed, np.random.SeedSequence):
+            seed_seq = np.random.SeedSequence(self.seed.entropy, spawn_key=self.seed.spawn_key)
+        else:
+            seed_seq = np.random.SeedSequence(self.seed)
+        children = []
+        for child_seed in seed_seq.spawn(n_children):
+            child = copy.copy(self)
+            child.seed = child_seed
+            child.reset()
+            children.append(child)
+        return children
@@ -0,0 +1,156 @@
+from contextlib import contextmanager
+import cProfile
+from dataclasses import dataclass, field
+import pstats
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, Optional
+
+
+STAGES = ('rng', 'traditional', 'roth', 'inflation', 'assembly')
+PROFILERS = ('cprofile', 'tracemalloc')
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    seconds: float = 0.
+    # Net bytes still held when the stage exits, and the largest transient allocation above the
+    # memory in use when it was entered
+    retained_bytes: int = 0
+    peak_bytes: int = 0
+
+    def merge(self, other: 'StageStats') -> 'StageStats':
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.retained_bytes += other.retained_bytes
+        self.peak_bytes = max(self.peak_bytes, other.peak_bytes)
+        return self
+
+
+@dataclass
+class StrategyStats:
+    n_paths: int
+    seconds: float
+    cached: bool = False
+
+    @property
+    def paths_per_second(self) -> Optional[float]:
+        return self.n_paths / self.seconds if self.seconds > 0 else None
+
+
+@dataclass
+class RunStats:
+    n_sims: int = 0
+    n_years: int = 0
+    seconds: float = 0.
+    peak_bytes: int = 0
+    stages: Dict[str, StageStats] = field(default_factory=lambda: {stage: StageStats() for stage in STAGES})
+    strategies: Dict[str, StrategyStats] = field(default_factory=dict)
+    profile: Optional[pstats.Stats] = field(default=None, repr=False)
+    memory_profile: Optional[List[tracemalloc.StatisticDiff]] = field(default=None, repr=False)
+
+    @property
+    def paths_per_second(self) -> Optional[float]:
+        n_paths = sum(s.n_paths for s in self.strategies.values() if not s.cached)
+        return n_paths / self.seconds if self.seconds > 0 else None
+
+    def merge(self, other: 'RunStats') -> 'RunStats':
+        for stage, stage_stats in other.stages.items():
+            self.stages[stage].merge(stage_stats)
+        self.peak_bytes = max(self.peak_bytes, other.peak_bytes)
+        return self
+
+    def report(self) -> str:
+        lines = [f"{'stage':<12}{'calls':>8}{'seconds':>12}{'share':>8}{'retained MB':>14}{'peak MB':>10}"]
+        stage_seconds = sum(s.seconds for s in self.stages.values()) or 1.
+        for stage, s in self.stages.items():
+            lines.append(
+                f'{stage:<12}{s.calls:>8,}{s.seconds:>12.4f}{s.seconds / stage_seconds:>8.1%}'
+                f'{s.retained_bytes / 1024 ** 2:>14,.1f}{s.peak_bytes / 1024 ** 2:>10,.1f}'
+            )
+        for key, s in self.strategies.items():
+            rate = 'cached' if s.cached else f'{s.paths_per_second or 0:,.0f} paths/s'
+            lines.append(f'{key}: {s.n_paths:,} paths, {rate}')
+        lines.append(f'total: {self.seconds:.4f}s, peak {self.peak_bytes / 1024 ** 2:,.1f} MB')
+        return '\n'.join(lines)
+
+
+@dataclass
+class Instrumentation:
+    # Opt-in timers and memory counters for the stages of run_simulations. Pass an instance as
+    # instrumentation=...; stats holds the last run's RunStats and callback, if given, receives it
+    track_memory: bool = False
+    profile_stage: Optional[str] = None
+    profiler: str = 'cprofile'
+    callback: Optional[Callable[[RunStats], None]] = field(default=None, repr=False)
+    stats: RunStats = field(default_factory=RunStats, init=False)
+
+    def __post_init__(self):
+        if self.profile_stage is not None and self.profile_stage not in STAGES:
+            raise ValueError(f'profile_stage must be one of {STAGES}')
+        if self.profiler not in PROFILERS:
+            raise ValueError(f'profiler must be one of {PROFILERS}')
+        self._profile = None
+        self._started_tracing = False
+
+    @property
+    def _tracing(self) -> bool:
+        return self.track_memory or (self.profile_stage is not None and self.profiler == 'tracemalloc')
+
+    def child(self) -> 'Instrumentation':
+        # Worker processes collect their own stage counters, which the parent merges; profiling and
+        # the callback stay in the parent process
+        return Instrumentation(track_memory=self.track_memory)
+
+    def start_run(self):
+        self.stats = RunStats()
+        self._profile = None
+        if self._tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def finish_run(self, seconds: float = 0.):
+        self.stats.seconds = seconds
+        if tracemalloc.is_tracing():
+            self.stats.peak_bytes = max(self.stats.peak_bytes, tracemalloc.get_traced_memory()[1])
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        if self._profile is not None:
+            self.stats.profile = pstats.Stats(self._profile)
+        if self.callback is not None:
+            self.callback(self.stats)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        stage_stats = self.stats.stages[name]
+        profiling = name == self.profile_stage
+        # Snapshots are only taken on the stage's first call; later chunks repeat the same allocations
+        snapshot = profiling and self.profiler == 'tracemalloc' and self.stats.memory_profile is None
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            self.stats.peak_bytes = max(self.stats.peak_bytes, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        if snapshot:
+            before_snapshot = tracemalloc.take_snapshot()
+        if profiling and self.profiler == 'cprofile':
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+            self._profile.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage_stats.seconds += time.perf_counter() - start
+            stage_stats.calls += 1
+            if profiling and self.profiler == 'cprofile':
+                self._profile.disable()
+            if snapshot:
+                self.stats.memory_profile = tracemalloc.take_snapshot().compare_to(before_snapshot, 'lineno')
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                stage_stats.retained_bytes += max(current - before, 0)
+                stage_stats.peak_bytes = max(stage_stats.peak_bytes, peak - before)
+                self.stats.peak_bytes = max(self.stats.peak_bytes, peak)
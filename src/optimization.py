@@ -0,0 +1,161 @@
+from dataclasses import dataclass, field
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence, Union
+
+
+import numpy as np
+
+
+from src.computations import compute_shortfall, simulate_batch, simulation_inputs
+from src.inputs import ParametricOptimizationInputs
+from src.interfaces import RetireeClass as Retiree
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def median_real_objective(floor: float = 0., floor_percentile: float = 5.) -> Callable:
+    # Median real ending balance, subject to the floor_percentile of real ending balances staying at or
+    # above floor. Candidates that miss the floor score below every feasible one, ranked by how far they miss
+    def objective(ending_real: np.ndarray, depleted: np.ndarray) -> np.ndarray:
+        median, low = np.percentile(ending_real, [50, floor_percentile], axis=-1)
+        return np.where(low >= floor, median, low - floor)
+    return objective
+
+
+def shortfall_objective() -> Callable:
+    # Lower probability of a withdrawal going unmet after retirement (see compute_shortfall) is better
+    def objective(ending_real: np.ndarray, depleted: np.ndarray) -> np.ndarray:
+        return 0. - depleted.mean(axis=-1)
+    return objective
+
+
+OBJECTIVES = dict(
+    median_real=median_real_objective,
+    shortfall=shortfall_objective,
+)
+
+
+def sample_glide_paths(
+    n_candidates: int,
+    inflection_points: Optional[Sequence[int]] = None,
+    min_stock: float = 0.,
+    max_stock: float = 1.,
+    step: float = 0.05,
+    seed: Optional[int] = None,
+) -> List[Dict[str, np.ndarray]]:
+    # Random custom_allocation parameters whose stock percentages never increase with age
+    if inflection_points is None:
+        inflection_points = np.array([35,45,55,65,70,75,80,85,90,95])
+    inflection_points = np.asarray(inflection_points)
+    rng = np.random.default_rng(seed)
+    stock_pcts = -np.sort(-rng.uniform(min_stock, max_stock, (n_candidates, inflection_points.size)), axis=1)
+    stock_pcts = np.clip((stock_pcts / step).round() * step, min_stock, max_stock).round(4)
+    return [dict(inflection_points=inflection_points, stock_pcts=pcts) for pcts in stock_pcts]
+
+
+@dataclass
+class OptimizationResult:
+    best_params: Dict[str, Any]
+    best_allocation: np.ndarray = field(repr=False)
+    best_score: float
+    leaderboard: 'pd.DataFrame' = field(repr=False)
+
+
+def optimize_allocation(
+    ret: Retiree,
+    ret_df: 'pd.DataFrame',
+    generator: Callable[..., np.ndarray],
+    candidates: List[Dict[str, Any]],
+    rng: ParametricOptimizationInputs,
+    objective: Union[str, Callable] = 'median_real',
+    start_age: Optional[int] = None,
+    end_age: Optional[int] = None,
+    n_sims: int = 10_000,
+    min_sims: int = 250,
+    eta: int = 3,
+    chunk_size: int = 8_192,
+) -> OptimizationResult:
+    # Successive halving over generator(**params) for each params dict in candidates. Every rung keeps
+    # the best 1/eta of the candidates and multiplies the paths per candidate by eta, finishing at n_sims.
+    # Each rung extends the same stream of return paths, so all candidates are compared on common random
+    # numbers and survivors only simulate the paths they have not seen yet. Ties in the objective are
+    # broken by median real ending balance.
+    import pandas as pd
+
+    if isinstance(objective, str):
+        objective = OBJECTIVES[objective]()
+    if start_age is None:
+        start_age = ret.age
+    if end_age is None:
+        end_age = ret.life_expectancy
+    inputs = simulation_inputs(ret, ret_df, start_age, end_age)
+    n_years = end_age - start_age + 1
+    retired = ret.ages_arr[start_age: end_age+1] > ret.retirement_age
+
+    start_time = time.time()
+
+    allocations = np.stack([
+        generator(**{'max_age': ret.life_expectancy, **params})[start_age: end_age+1] for params in candidates
+    ])
+    n_rungs = int(np.ceil(np.log(len(candidates)) / np.log(eta))) if len(candidates) > 1 else 0
+    rung_sims = [max(min(min_sims, n_sims), n_sims // eta ** (n_rungs - r)) for r in range(n_rungs + 1)]
+
+    ending_real = [[] for _ in candidates]
+    depleted = [[] for _ in candidates]
+    scores = np.full(len(candidates), -np.inf)
+    medians = np.full(len(candidates), -np.inf)
+    rung_reached = np.zeros(len(candidates), dtype=int)
+    sims_evaluated = np.zeros(len(candidates), dtype=int)
+
+    rng.reset()
+    alive = np.arange(len(candidates))
+    n_done = 0
+    for rung, n_rung in enumerate(rung_sims):
+        # Paths are simulated for every live candidate at once, a chunk at a time
+        n_chunk = max(1, chunk_size // alive.size)
+        for start in range(n_done, n_rung, n_chunk):
+            stop = min(start + n_chunk, n_rung)
+            results = simulate_batch(
+                allocations=allocations[alive],
+                rates=rng.generate_batch(stop - start, n_years),
+                **inputs,
+            )
+            portfolio_real = results['traditional_balance_real'] + results['roth_balance_real']
+            shortfall = compute_shortfall(results['roth_withdrawals'], results['roth_balance'], retired)
+            for i, c in enumerate(alive):
+                ending_real[c].append(portfolio_real[i, -1])
+                depleted[c].append(shortfall[i])
+        n_done = max(n_done, n_rung)
+
+        alive_ending_real = np.stack([np.concatenate(ending_real[c]) for c in alive])
+        scores[alive] = objective(alive_ending_real, np.stack([np.concatenate(depleted[c]) for c in alive]))
+        medians[alive] = np.median(alive_ending_real, axis=-1)
+        rung_reached[alive] = rung
+        sims_evaluated[alive] = n_rung
+        # Best first: by score, then by median
+        alive = alive[np.lexsort((-medians[alive], -scores[alive]))]
+        if rung < n_rungs:
+            alive = alive[:max(1, int(np.ceil(alive.size / eta)))]
+
+    total_time = time.time() - start_time
+
+    best = alive[0]
+    leaderboard = pd.DataFrame(dict(
+        params=candidates,
+        rung=rung_reached,
+        n_sims=sims_evaluated,
+        score=scores,
+        median_real=medians,
+        p5_real=[np.percentile(np.concatenate(e), 5) for e in ending_real],
+        shortfall_probability=[np.concatenate(d).mean() for d in depleted],
+    )).sort_values(['rung', 'score', 'median_real'], ascending=False)
+
+    print(f'Done. {int(sims_evaluated.sum()):,} simulations of {end_age - start_age:,} years across '
+          f'{len(candidates):,} candidates took {total_time:0.2f}s')
+    return OptimizationResult(
+        best_params=candidates[best],
+        best_allocation=generator(**{'max_age': ret.life_expectancy, **candidates[best]}),
+        best_score=float(scores[best]),
+        leaderboard=leaderboard,
+    )
@@ -1,13 +1,17 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 
 from matplotlib import pyplot as plt
 from matplotlib import ticker
+from matplotlib.collections import LineCollection
 import numpy as np
 import pandas as pd
 import seaborn as sns
 
 
+from src.summaries import YearlySummary
+
+
 def plot_single_time_series(results, n_sims, years, title, fill: bool = True):
     for n in range(0, n_sims):
         plt.plot(years, results[n])
@@ -21,24 +25,79 @@ def plot_single_time_series(results, n_sims, years, title, fill: bool = True):
     plt.show()
 
 
+def compute_fan_bands(
+        portfolio_balance: np.ndarray,
+        percentiles: Sequence[float] = (5, 25, 50, 75, 95),
+) -> np.ndarray:
+    # (len(percentiles), years) from a (years, n_sims) matrix; np.quantile partitions once for all percentiles
+    return np.quantile(portfolio_balance, np.asarray(percentiles) / 100, axis=1)
+
+
+def _plot_fan(
+        ax,
+        years,
+        bands: np.ndarray,
+        percentiles: Sequence[float],
+        sample_paths: Optional[np.ndarray] = None,
+        color=None,
+):
+    color = color or sns.color_palette()[0]
+    if sample_paths is not None and sample_paths.shape[1]:
+        segments = np.stack(np.broadcast_arrays(np.asarray(years)[:, None], sample_paths), axis=-1)
+        ax.add_collection(LineCollection(segments.transpose(1, 0, 2), colors='0.4', linewidths=0.5, alpha=0.5))
+    # Shade symmetric percentile pairs from the outside in, then draw the innermost percentile as a line
+    n_pairs = len(percentiles) // 2
+    for j in range(n_pairs):
+        ax.fill_between(years, bands[j], bands[-(j + 1)], color=color, alpha=0.15 + 0.15 * j, linewidth=0,
+                        label=f'{percentiles[j]:g}-{percentiles[-(j + 1)]:g}%')
+    if len(percentiles) % 2:
+        ax.plot(years, bands[n_pairs], color=color, linewidth=1.5, label=f'{percentiles[n_pairs]:g}%')
+    ax.autoscale_view()
+
+
 def plot_time_series(
         simulation_results,
         years,
         fill: bool = True,
         div_factor: int = 1_000_000,
+        mode: str = 'paths',
+        percentiles: Sequence[float] = (5, 25, 50, 75, 95),
+        n_sample_paths: int = 0,
+        seed: Optional[int] = None,
 ):
+    # mode='fan' draws percentile bands instead of every path. simulation_results may then also hold the
+    # YearlySummary dicts from summarize_simulations, in which case no raw paths are needed.
     n_plots = len(simulation_results)
     fig, axs = plt.subplots(n_plots,1, sharex=True, figsize=(10.5,n_plots*2))
+    axs = np.atleast_1d(axs)
+    rng = np.random.default_rng(seed)
 
     for i, sim_name in enumerate(simulation_results.keys()):
+        axs[i].yaxis.set_major_formatter(ticker.StrMethodFormatter('${x:,.0f}'))
+        axs[i].set_title(sim_name.replace('\n', ' '))
+        axs[i].set_ylabel(f'Balance, in ${div_factor:,.0f}')
+
+        if mode == 'fan':
+            summary = simulation_results[sim_name].get('portfolio_balance')
+            sample_paths = None
+            if summary is not None:
+                bands = summary.quantile(np.asarray(percentiles) / 100) / div_factor
+            else:
+                portfolio_balance = simulation_results[sim_name]['traditional_balance'] + simulation_results[sim_name]['roth_balance']
+                bands = compute_fan_bands(portfolio_balance, percentiles) / div_factor
+                if n_sample_paths:
+                    sample_idx = rng.choice(portfolio_balance.shape[1], min(n_sample_paths, portfolio_balance.shape[1]), replace=False)
+                    sample_paths = portfolio_balance[:, np.sort(sample_idx)] / div_factor
+            _plot_fan(axs[i], years, bands, percentiles, sample_paths=sample_paths)
+            continue
+        elif mode != 'paths':
+            raise ValueError(f'Unknown plot mode {mode}')
+
         portfolio_balance = simulation_results[sim_name]['traditional_balance'] + simulation_results[sim_name]['roth_balance']
         portfolio_balance = portfolio_balance / div_factor
         portfolio_df = pd.DataFrame(portfolio_balance, columns=range(portfolio_balance.shape[1]))
         portfolio_df.insert(0, 'years', years)
         portfolio_df = portfolio_df.melt(id_vars='years')
-        axs[i].yaxis.set_major_formatter(ticker.StrMethodFormatter('${x:,.0f}'))
-        axs[i].set_title(sim_name.replace('\n', ' '))
-        axs[i].set_ylabel(f'Balance, in ${div_factor:,.0f}')
         
         g = sns.lineplot(portfolio_df, x='years', y='value', hue='variable', ax=axs[i], palette=sns.color_palette(n_colors=portfolio_balance.shape[1]), legend=None)
         
@@ -47,14 +106,98 @@ def plot_time_series(
             max_vals = portfolio_balance.max(axis=1)
             g.fill_between(years, min_vals, max_vals, alpha = 0.2)
     
+    if mode == 'fan':
+        axs[0].legend(loc='upper left', fontsize='small')
     axs[i].set_xlabel('Years')
     
     fig.tight_layout()
     return fig, axs
 
 
+ENDING_BALANCE_QUANTILES = {
+    '5%': .05,
+    '10%': .10,
+    '25%': .25,
+    'Median': .50,
+    '75%': .75,
+    '90%': .90,
+    '95%': .95,
+}
+
+
+def _binned_kde(
+        grid_counts: np.ndarray,
+        grid_edges: np.ndarray,
+        n: int,
+        std: float,
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    # Gaussian KDE (Scott's bandwidth) evaluated by convolving binned counts with the kernel, so the cost
+    # depends on the grid size rather than the number of samples
+    bandwidth = std * n ** (-1 / 5)
+    dx = grid_edges[1] - grid_edges[0]
+    if n < 2 or bandwidth <= 0 or dx <= 0:
+        return None
+    half_width = min(int(np.ceil(4 * bandwidth / dx)), grid_counts.shape[0] - 1)
+    offsets = np.arange(-half_width, half_width + 1) * dx
+    # Sampled on the grid and renormalised, so the density integrates to 1 even when the bandwidth is
+    # narrower than a grid step
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    kernel /= kernel.sum() * dx
+    density = np.convolve(grid_counts, kernel)[half_width: half_width + grid_counts.shape[0]] / n
+    return (grid_edges[:-1] + grid_edges[1:]) / 2, density
+
+
+def summarize_ending_balances(
+        ending_balances: Union[np.ndarray, YearlySummary],
+        bins: np.ndarray,
+        div_factor: float = 1.,
+        kde_points: int = 512,
+) -> Dict:
+    # Every plotted statistic, the histogram counts over bins and a KDE scaled to those counts, from one
+    # sort of the ending balances (or from the final year of a YearlySummary). bins are in div_factor units.
+    bin_width = bins[1] - bins[0]
+    qs = np.array(list(ENDING_BALANCE_QUANTILES.values()))
+    if isinstance(ending_balances, YearlySummary):
+        n = ending_balances.count
+        low, high = ending_balances.min[-1] / div_factor, ending_balances.max[-1] / div_factor
+        mean, std = ending_balances.mean[-1] / div_factor, ending_balances.std[-1] / div_factor
+        quantiles = ending_balances.quantile(qs)[:, -1] / div_factor
+        digitized_counts = np.concatenate((
+            [0], ending_balances.histogram(bins * div_factor), [0]))
+        grid_edges = np.linspace(low, high, kde_points + 1)
+        grid_counts = ending_balances.histogram(grid_edges * div_factor)
+    else:
+        values = np.sort(np.ravel(ending_balances)) / div_factor
+        n = values.shape[0]
+        low, high = values[0], values[-1]
+        mean, std = values.mean(), values.std(ddof=1)
+        quantiles = np.quantile(values, qs)
+        # Counts per np.digitize(values, bins) index: 0 is below bins[0], len(bins) is at or above bins[-1]
+        digitized_counts = np.diff(np.concatenate(([0], np.searchsorted(values, bins), [n])))
+        grid_edges = np.linspace(low, high, kde_points + 1)
+        grid_counts = np.diff(np.searchsorted(values, grid_edges, side='right'))
+        grid_counts[0] += np.searchsorted(values, grid_edges[0], side='right')
+    stats = {
+        'Low': low,
+        'Mode': bins[min(np.argmax(digitized_counts), bins.shape[0] - 1)] - bin_width/2,
+        'Mean': mean,
+        'High': high,
+    }
+    stats.update(zip(ENDING_BALANCE_QUANTILES, quantiles))
+    kde = _binned_kde(grid_counts, grid_edges, n, std)
+    if kde is not None:
+        kde = (kde[0], kde[1] * n * bin_width)
+    return dict(
+        n=n,
+        stats={k: stats[k] for k in ['Low', '5%', '10%', 'Mode', '25%', 'Median', 'Mean', '75%', '90%', '95%', 'High']},
+        bins=bins,
+        counts=digitized_counts[1:-1],
+        kde=kde,
+    )
+
+
 def plot_ending_balance_hist(
-    simulation_results: Dict[str, np.ndarray],
+    simulation_results: Dict[str, Union[np.ndarray, YearlySummary]],
     n_sims: int,
     start_age: int,
     end_age: int,
@@ -64,14 +207,23 @@ def plot_ending_balance_hist(
     xmax: float = 30,
     lines_to_show: Optional[List[str]] = None,
 ):
+    # simulation_results maps strategy names to ending balances, or to a YearlySummary (e.g. the
+    # portfolio_balance summary from summarize_simulations) whose final year is plotted
     n_plots = len(simulation_results)
     fig, axs = plt.subplots(n_plots,1, sharex=True, sharey=True, figsize=(10.5,n_plots*2))
+    axs = np.atleast_1d(axs)
     
     bin_max = 0
     for sim_result in simulation_results.values():
-        bin_max = max(bin_max, sim_result.max() / div_factor)
+        sim_max = sim_result.max[-1] if isinstance(sim_result, YearlySummary) else sim_result.max()
+        bin_max = max(bin_max, sim_max / div_factor)
     
     bins = np.arange(0,bin_max + bin_width, bin_width)
+    summaries = {
+        sim_name: summarize_ending_balances(sim_result, bins, div_factor)
+        for sim_name, sim_result in simulation_results.items()
+    }
+    color = sns.color_palette()[0]
         
     for i, sim_name in enumerate(simulation_results.keys()):
         
@@ -80,8 +232,10 @@ def plot_ending_balance_hist(
 #         axs[i].tick_params(left=False)
         axs[i].set_yticks([])
         
-#         sns.histplot(simulation_results[sim_name]/div_factor, ax=axs[i], binwidth=bin_width, kde=True)
-        sns.histplot(simulation_results[sim_name]/div_factor, ax=axs[i], bins=bins, kde=True)
+        # Histogram and KDE are drawn from the binned summary rather than the raw samples
+        axs[i].hist(bins[:-1], bins=bins, weights=summaries[sim_name]['counts'], color=color, alpha=0.75, edgecolor='white')
+        if summaries[sim_name]['kde'] is not None:
+            axs[i].plot(*summaries[sim_name]['kde'], color=color)
 
     axs[i].set_xlabel(f'Ending balance, in ${div_factor:,.0f}')
 
@@ -98,19 +252,7 @@ def plot_ending_balance_hist(
     
     for i, sim_name in enumerate(simulation_results.keys()):
         
-        sub_lines = {
-            'Low': simulation_results[sim_name].min()/div_factor,
-            '5%': np.quantile(simulation_results[sim_name], .05)/div_factor,
-            '10%': np.quantile(simulation_results[sim_name], .10)/div_factor,
-            'Mode': bins[np.argmax(np.bincount(np.digitize(simulation_results[sim_name]/div_factor, bins)))] - bin_width/2,
-            '25%': np.quantile(simulation_results[sim_name], .25)/div_factor,
-            'Median': np.median(simulation_results[sim_name])/div_factor,
-            'Mean': simulation_results[sim_name].mean()/div_factor,
-            '75%': np.quantile(simulation_results[sim_name], .75)/div_factor,
-            '90%': np.quantile(simulation_results[sim_name], .90)/div_factor,
-            '95%': np.quantile(simulation_results[sim_name], .95)/div_factor,
-            'High': simulation_results[sim_name].max()/div_factor,
-        }
+        sub_lines = summaries[sim_name]['stats']
         
         if lines_to_show is None:
             lines_to_show = sub_lines.keys()
@@ -1,48 +1,185 @@
 from dataclasses import dataclass, field
 from datetime import datetime as dt
-from typing import Optional
+from typing import Dict, Optional, Sequence, Union
 
 
 import numpy as np
-import pandas as pd
 
 
 from src.accounts import Four01k, IRA
+from src.derived import DependencyTracked, derived
 from src.interfaces import RetireeClass
 from src.ssi import calc_ssi_income_array
-from src.tax_computations import IncomeTaxes
+from src.tax_computations import compute_after_tax_income
 
 
 @dataclass
-class Retiree(RetireeClass):
-    
-    def __post_init__(self):
-        self.__calc_income_array()
-        self.years_arr = np.arange(self.year - self.age, self.year + 1 + (self.life_expectancy - self.age))
-        self.ages_arr = np.arange(0, self.life_expectancy + 1)
-        self.ssi_arr = calc_ssi_income_array(self)
-        self.withdrawal_arr = np.where(
-            self.ages_arr <= self.retirement_age, 0., self.desired_retirement_income - self.ssi_arr
-        )
-        self.inflation_arr = (np.repeat([0.0, -self.inflation_rate/(1+self.inflation_rate)],
-                                        [self.age, self.life_expectancy]))[:self.life_expectancy + 1]
-
-    def __calc_income_array(self):
+class Retiree(RetireeClass, DependencyTracked):
+    # The arrays below are computed on first use and recomputed only after a field they depend on changes
+
+    @derived('income_history', 'age', 'retirement_age', 'current_income', 'raise_rate', 'max_income', 'life_expectancy')
+    def income_arr(self) -> np.ndarray:
         if self.income_history is None:
-            self.income_history = np.zeros((self.age,))
+            income_history = np.zeros((self.age,))
         elif self.income_history.shape[0] < self.age:
-            self.income_history = np.pad(self.income_history, ((self.age) - self.income_history.shape[0], 0))
+            income_history = np.pad(self.income_history, ((self.age) - self.income_history.shape[0], 0))
         else:
-            self.income_history = self.income_history[:-(self.age)]
-        
+            income_history = self.income_history[:-(self.age)]
+
         working_income = np.array([self.current_income] * (self.retirement_age - self.age + 1))
         cumulative_raise = (np.pad(np.array([self.raise_rate] * (self.retirement_age - self.age)), (1,0)) + 1).cumprod()
-        working_income = np.clip(np.concatenate((self.income_history, cumulative_raise * working_income)), 0, self.max_income)
+        working_income = np.clip(np.concatenate((income_history, cumulative_raise * working_income)), 0, self.max_income)
         if self.life_expectancy + 1 > working_income.shape[0]:
-            self.income_arr = np.pad(working_income, (0,self.life_expectancy + 1 - working_income.shape[0]))
+            income_arr = np.pad(working_income, (0,self.life_expectancy + 1 - working_income.shape[0]))
         else:
-            self.income_arr = working_income[:self.life_expectancy + 1]
-        self.income_arr = self.income_arr.round(2)
+            income_arr = working_income[:self.life_expectancy + 1]
+        return income_arr.round(2)
+
+    @derived('year', 'age', 'life_expectancy')
+    def years_arr(self) -> np.ndarray:
+        return np.arange(self.year - self.age, self.year + 1 + (self.life_expectancy - self.age))
+
+    @derived('life_expectancy')
+    def ages_arr(self) -> np.ndarray:
+        return np.arange(0, self.life_expectancy + 1)
+
+    @derived('years_arr', 'income_arr', 'life_expectancy')
+    def ssi_arr(self) -> np.ndarray:
+        return calc_ssi_income_array(self)
+
+    @derived('ages_arr', 'retirement_age', 'desired_retirement_income', 'ssi_arr')
+    def withdrawal_arr(self) -> np.ndarray:
+        return np.where(self.ages_arr <= self.retirement_age, 0., self.desired_retirement_income - self.ssi_arr)
+
+    @derived('inflation_rate', 'age', 'life_expectancy')
+    def inflation_arr(self) -> np.ndarray:
+        return (np.repeat([0.0, -self.inflation_rate/(1+self.inflation_rate)],
+                          [self.age, self.life_expectancy]))[:self.life_expectancy + 1]
+
+
+RET_COLUMNS = (
+    'year',
+    'age',
+    'earnings',
+    'net_earnings',
+    'r_401k_dep',
+    't_401k_dep',
+    't_401k_match_dep',
+    'r_ira_dep',
+    't_ira_dep',
+    'total_roth_dep',
+    'total_trad_dep',
+    'ssi_income',
+    'with',
+)
+
+
+def contribution_waterfall(
+    income: np.ndarray,
+    roth_ira_max: np.ndarray,
+    total_ira_max: np.ndarray,
+    roth_401k_max: np.ndarray,
+    employee_401k_max: np.ndarray,
+    effective_tax_rate: np.ndarray,
+    min_net_income: np.ndarray,
+    max_contrib_pct: np.ndarray,
+    employer_match_rate: np.ndarray,
+    employer_match_ratio: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    # Arrays are (n_retirees, ages) and per-retiree parameters (n_retirees, 1). Deposits fill
+    # Roth IRA -> traditional IRA -> Roth 401k -> traditional 401k, then the employer match.
+    max_dep = np.clip( (income  * (1-effective_tax_rate)) - min_net_income, 0.0, income * (max_contrib_pct))
+    r_ira_dep = np.clip(roth_ira_max, 0.0, max_dep ).round(2)
+    max_dep = np.clip(max_dep - r_ira_dep , 0, None)
+
+    t_ira_dep = np.clip(
+        total_ira_max - r_ira_dep,
+        0.0, max_dep/(1+effective_tax_rate)).round(2)
+    max_dep = np.clip(max_dep - (t_ira_dep/(1+effective_tax_rate)), 0, None)
+    r_401k_dep = np.clip(roth_401k_max, 0.0, max_dep ).round(2)
+    max_dep = np.clip(max_dep - r_401k_dep , 0, None)
+    t_401k_dep = np.clip(
+        employee_401k_max - r_401k_dep,
+        0.0, max_dep/(1+effective_tax_rate)).round(2)
+    t_401k_match_dep = np.clip(
+        (t_401k_dep + r_401k_dep) * employer_match_ratio,
+        0., income * employer_match_rate * employer_match_ratio,
+    ).round(2)
+    return dict(
+        r_401k_dep=r_401k_dep,
+        t_401k_dep=t_401k_dep,
+        t_401k_match_dep=t_401k_match_dep,
+        r_ira_dep=r_ira_dep,
+        t_ira_dep=t_ira_dep,
+    )
+
+
+def make_ret_arrays(
+    rets: Sequence[RetireeClass],
+    ret_401ks: Sequence[Four01k],
+    ret_iras: Sequence[IRA],
+    starting_roth_ira: Union[float, np.ndarray] = 0.,
+    starting_roth_401k: Union[float, np.ndarray] = 0.,
+    starting_trad_ira: Union[float, np.ndarray] = 0.,
+    starting_trad_401k: Union[float, np.ndarray] = 0.,
+    starting_trad_match_401k: Union[float, np.ndarray] = 0.,
+) -> Dict[str, np.ndarray]:
+    # Struct-of-arrays version of make_ret_df: every column is (n_retirees, ages)
+    if len({ret.life_expectancy for ret in rets}) > 1:
+        raise ValueError('All retirees must share the same life_expectancy')
+
+    def stack(objs, attr):
+        return np.stack([getattr(obj, attr) for obj in objs])
+
+    def column(objs, attr):
+        return np.array([getattr(obj, attr) for obj in objs], dtype=float)[:, None]
+
+    income = stack(rets, 'income_arr')
+    ret_arrays = dict(
+        year=stack(rets, 'years_arr'),
+        age=stack(rets, 'ages_arr'),
+        earnings=income,
+    )
+    ret_arrays.update(contribution_waterfall(
+        income=income,
+        roth_ira_max=stack(ret_iras, 'roth_max_arr'),
+        total_ira_max=stack(ret_iras, 'total_max_arr'),
+        roth_401k_max=stack(ret_401ks, 'roth_max_arr'),
+        employee_401k_max=stack(ret_401ks, 'employee_max_arr'),
+        effective_tax_rate=column(rets, 'effective_tax_rate'),
+        min_net_income=column(rets, 'min_net_income'),
+        max_contrib_pct=column(rets, 'max_contrib_pct'),
+        employer_match_rate=column(ret_401ks, 'employer_match_rate'),
+        employer_match_ratio=column(ret_401ks, 'employer_match_ratio'),
+    ))
+
+    ret_arrays['net_earnings'] = (
+        compute_after_tax_income(
+            income - (ret_arrays['t_401k_dep'] + ret_arrays['t_ira_dep']),
+            'NY', 'NYC', 2022,
+        ) - (ret_arrays['r_401k_dep'] + ret_arrays['r_ira_dep'])
+    )
+
+    idx = (np.arange(len(rets)), np.array([ret.age for ret in rets]))
+    for col, starting in zip(
+        ['r_401k_dep', 'r_ira_dep', 't_401k_dep', 't_401k_match_dep', 't_ira_dep'],
+        [starting_roth_401k, starting_roth_ira, starting_trad_401k, starting_trad_match_401k, starting_trad_ira],
+    ):
+        ret_arrays[col][idx] += starting
+
+    ret_arrays['total_roth_dep'] = ret_arrays['r_401k_dep'] + ret_arrays['r_ira_dep']
+    ret_arrays['total_trad_dep'] = (
+        ret_arrays['t_401k_dep'] + ret_arrays['t_401k_match_dep'] + ret_arrays['t_ira_dep']
+    )
+    ret_arrays['ssi_income'] = stack(rets, 'ssi_arr')
+    ret_arrays['with'] = stack(rets, 'withdrawal_arr')
+    return {col: ret_arrays[col] for col in RET_COLUMNS}
+
+
+def ret_arrays_to_df(ret_arrays: Dict[str, np.ndarray], index: int = 0):
+    import pandas as pd
+
+    return pd.DataFrame({col: ret_arrays[col][index] for col in RET_COLUMNS})
 
 
 def make_ret_df(
@@ -55,55 +192,12 @@ def make_ret_df(
     starting_trad_401k: float = 0.,
     starting_trad_match_401k: float = 0.,
 ):
-    ret_df = pd.DataFrame()
-
-    ret_df['year'] = ret.years_arr
-    ret_df['age'] = ret.ages_arr
-    ret_df['earnings'] = ret.income_arr
-    ret_df['net_earnings'] = 0.
-
-
-    ret_df['r_401k_dep'] = 0.
-    ret_df['t_401k_dep'] = 0.
-    ret_df['t_401k_match_dep'] = 0.
-    ret_df['r_ira_dep'] = 0.
-    ret_df['t_ira_dep'] = 0.
-
-
-    max_dep = np.clip( (ret.income_arr  * (1-ret.effective_tax_rate)) - ret.min_net_income, 0.0, ret.income_arr * (ret.max_contrib_pct))
-    ret_df['r_ira_dep'] = np.clip(ret_ira.roth_max_arr, 0.0, max_dep ).round(2)
-    max_dep = np.clip(max_dep - ret_df['r_ira_dep'].values , 0, None)
-    
-    ret_df['t_ira_dep'] = np.clip(
-        ret_ira.total_max_arr - ret_df['r_ira_dep'].values,
-        0.0, max_dep/(1+ret.effective_tax_rate)).round(2)
-    max_dep = np.clip(max_dep - (ret_df['t_ira_dep'].values/(1+ret.effective_tax_rate)), 0, None)
-    ret_df['r_401k_dep'] = np.clip(ret_401k.roth_max_arr, 0.0, max_dep ).round(2)
-    max_dep = np.clip(max_dep - ret_df['r_401k_dep'].values , 0, None)
-    ret_df['t_401k_dep'] = np.clip(
-        ret_401k.employee_max_arr - ret_df['r_401k_dep'].values,
-        0.0, max_dep/(1+ret.effective_tax_rate)).round(2)
-    max_dep = np.clip(max_dep - (ret_df['t_401k_dep'].values/(1+ret.effective_tax_rate)), 0, None)
-    ret_df['t_401k_match_dep'] = ret_401k.employer_max_arr(ret_df[['t_401k_dep', 'r_401k_dep']].sum(axis=1)).round(2)
-
-    ret_df['net_earnings'] = (
-        (
-            ret_df['earnings'] - ret_df[['t_401k_dep','t_ira_dep']].sum(axis=1)
-        ).apply(
-            lambda x: IncomeTaxes(x, 'NY', 'NYC', 2022).get_after_tax_income()
-        ) - ret_df[['r_401k_dep','r_ira_dep']].sum(axis=1)
+    ret_arrays = make_ret_arrays(
+        [ret], [ret_401k], [ret_ira],
+        starting_roth_ira=starting_roth_ira,
+        starting_roth_401k=starting_roth_401k,
+        starting_trad_ira=starting_trad_ira,
+        starting_trad_401k=starting_trad_401k,
+        starting_trad_match_401k=starting_trad_match_401k,
     )
-
-    ret_df.loc[ret.age, 'r_401k_dep'] += starting_roth_401k
-    ret_df.loc[ret.age, 'r_ira_dep'] += starting_roth_ira
-    ret_df.loc[ret.age, 't_401k_dep'] += starting_trad_401k
-    ret_df.loc[ret.age, 't_401k_match_dep'] += starting_trad_match_401k
-    ret_df.loc[ret.age, 't_ira_dep'] += starting_trad_ira
-
-    ret_df['total_roth_dep'] = ret_df[['r_401k_dep','r_ira_dep']].sum(axis=1)
-    ret_df['total_trad_dep'] = ret_df[['t_401k_dep','t_401k_match_dep','t_ira_dep']].sum(axis=1)
-
-    ret_df['ssi_income'] = ret.ssi_arr
-    ret_df['with'] = ret.withdrawal_arr
-
-    return ret_df
\ No newline at end of file
+    return ret_arrays_to_df(ret_arrays)
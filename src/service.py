@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+import numpy as np
+
+
+from cache.results import ResultCache
+from src.cli import load_scenario, make_retiree_inputs, make_rng, make_strategies, summarize_results
+from src.computations import DEFAULT_CHUNK_SIZE, DEFAULT_SHARD_SIZE, run_simulations
+from src.tax_computations import compute_after_tax_income
+
+# Long-running local service: python -m src.service --socket PATH (or --port N). Clients send one JSON
+# request per line, in the scenario format of src.cli, and get one JSON line back per request, carrying
+# the request's "id" if it had one.
+
+CLIENT_SECTIONS = ('retiree', 'four01k', 'ira', 'starting_balances')
+
+
+def _run_options(request: Dict[str, Any]) -> Dict[str, Any]:
+    # Everything besides the retiree and strategies that decides the paths, with the defaults of src.cli.
+    # Requests are only batched when these agree, so each response matches python -m src on its scenario.
+    return dict(
+        rng=request.get('rng', dict()),
+        start_age=request.get('start_age'),
+        end_age=request.get('end_age'),
+        n_sims=request.get('n_sims', 10_000),
+        chunk_size=request.get('chunk_size', DEFAULT_CHUNK_SIZE),
+        workers=request.get('workers'),
+        shard_size=request.get('shard_size', DEFAULT_SHARD_SIZE),
+    )
+
+
+def _canonical(obj: Any) -> str:
+    return json.dumps(obj, sort_keys=True)
+
+
+@dataclass
+class SimulationService:
+    # Keeps rng inputs, retiree contribution tables, allocations and the tax tables warm between requests.
+    # Requests arriving within coalesce_window of each other that share the rng config, age window, n_sims,
+    # chunk_size, workers and shard_size are batched: each retiree among them gets one run_simulations call
+    # over the union of the strategies requested for it, so every strategy still sees the same paths as
+    # when run alone.
+    coalesce_window: float = 0.02
+    max_cached: int = 256
+    cache: Optional[ResultCache] = None
+    n_requests: int = field(default=0, init=False)
+    n_runs: int = field(default=0, init=False)
+
+    def __post_init__(self):
+        self._rngs = dict()
+        self._retirees = OrderedDict()
+        self._allocations = OrderedDict()
+        self._pending = dict()
+        # rng inputs are stateful, so simulations run one at a time off the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _lookup(self, cache: OrderedDict, key: str, build: Callable[[], Any]) -> Any:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = cache[key] = build()
+        if len(cache) > self.max_cached:
+            cache.popitem(last=False)
+        return value
+
+    def warm(self, scenarios: Optional[List[Dict[str, Any]]] = None):
+        # Compiles the tax tables and, for each scenario, builds its rng inputs, retiree and strategies
+        compute_after_tax_income(np.zeros(1), 'NY', 'NYC', 2022)
+        for scenario in scenarios or []:
+            ret, _ = self._retiree(scenario)
+            self._rng(scenario.get('rng', dict()))
+            self._strategies(scenario['strategies'], ret.life_expectancy)
+
+    def _rng(self, config: Dict[str, Any]):
+        # Unbounded: run_simulations resets the rng, and there are few distinct configs
+        key = _canonical(config)
+        if key not in self._rngs:
+            self._rngs[key] = make_rng(config)
+        return self._rngs[key]
+
+    def _retiree(self, request: Dict[str, Any]):
+        client = {section: request.get(section) for section in CLIENT_SECTIONS}
+        return self._lookup(self._retirees, _canonical(client), lambda: make_retiree_inputs(request))
+
+    def _strategies(self, config: Dict[str, Dict[str, Any]], max_age: int) -> Dict[str, Tuple[str, np.ndarray]]:
+        # name -> (key shared by every request asking for the same allocation, allocation)
+        strategies = dict()
+        for name, strategy in config.items():
+            key = _canonical([strategy, max_age])
+            strategies[name] = key, self._lookup(
+                self._allocations, key, lambda: make_strategies({name: strategy}, max_age)[name],
+            )
+        return strategies
+
+    async def submit(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        for section in ('retiree', 'strategies'):
+            if section not in request:
+                raise ValueError(f'Request has no {section!r} section')
+        self.n_requests += 1
+        key = _canonical(_run_options(request))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if key not in self._pending:
+            self._pending[key] = []
+            loop.call_later(self.coalesce_window, lambda: asyncio.ensure_future(self._flush(key)))
+        self._pending[key].append((request, future))
+        return await future
+
+    async def _flush(self, key: str):
+        batch = self._pending.pop(key)
+        try:
+            responses = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._run_batch, [request for request, _ in batch],
+            )
+        except Exception as e:
+            responses = [e] * len(batch)
+        for (_, future), response in zip(batch, responses):
+            if future.cancelled():
+                continue
+            if isinstance(response, Exception):
+                future.set_exception(response)
+            else:
+                future.set_result(response)
+
+    def _run_batch(self, requests: List[Dict[str, Any]]) -> List[Any]:
+        # Responses, or the exception raised for them, in request order. A request with bad inputs fails
+        # alone; a failing run fails every request in it.
+        responses = [None] * len(requests)
+        groups = dict()
+        for i, request in enumerate(requests):
+            try:
+                ret, ret_columns = self._retiree(request)
+                strategies = self._strategies(request['strategies'], ret.life_expectancy)
+            except Exception as e:
+                responses[i] = e
+                continue
+            client = _canonical({section: request.get(section) for section in CLIENT_SECTIONS})
+            groups.setdefault(client, (ret, ret_columns, request, []))[-1].append((i, strategies))
+        for ret, ret_columns, first, members in groups.values():
+            try:
+                group_responses = self._run_group(ret, ret_columns, first, [strategies for _, strategies in members])
+            except Exception as e:
+                group_responses = [e] * len(members)
+            for (i, _), response in zip(members, group_responses):
+                responses[i] = response
+        return responses
+
+    def _run_group(
+        self,
+        ret,
+        ret_columns: Dict[str, np.ndarray],
+        first: Dict[str, Any],
+        strategies: List[Dict[str, Tuple[str, np.ndarray]]],
+    ) -> List[Dict[str, Any]]:
+        options = _run_options(first)
+        start_age = ret.age if options['start_age'] is None else options['start_age']
+        end_age = ret.life_expectancy if options['end_age'] is None else options['end_age']
+        n_sims = options['n_sims']
+        allocation_strats = {key: allocation for strats in strategies for key, allocation in strats.values()}
+        results = run_simulations(
+            ret, ret_columns, allocation_strats, self._rng(options['rng']),
+            start_age=start_age,
+            end_age=end_age,
+            n_sims=n_sims,
+            workers=options['workers'],
+            shard_size=options['shard_size'],
+            chunk_size=options['chunk_size'],
+            cache=self.cache,
+        )
+        self.n_runs += 1
+        summaries = summarize_results(ret, results, start_age, end_age)
+        return [
+            dict(
+                n_sims=n_sims,
+                start_age=start_age,
+                end_age=end_age,
+                coalesced=len(strategies),
+                strategies={name: summaries[key] for name, (key, _) in strats.items()},
+            )
+            for strats in strategies
+        ]
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Requests on one connection are served concurrently, so a burst over a single connection coalesces
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def respond(line: bytes):
+            request = None
+            try:
+                request = json.loads(line)
+                message = dict(result=await self.submit(request))
+            except Exception as e:
+                message = dict(error=f'{type(e).__name__}: {e}')
+            if isinstance(request, dict) and 'id' in request:
+                message['id'] = request['id']
+            async with lock:
+                writer.write((json.dumps(message) + '\n').encode())
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(respond(line))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: Optional[str] = None, host: str = '127.0.0.1', port: Optional[int] = None):
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+
+async def request_simulation(
+    request: Dict[str, Any],
+    socket_path: Optional[str] = None,
+    host: str = '127.0.0.1',
+    port: Optional[int] = None,
+) -> Dict[str, Any]:
+    # Sends one request to a running service and returns its response
+    if socket_path is not None:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write((json.dumps(request) + '\n').encode())
+        await writer.drain()
+        message = json.loads(await reader.readline())
+    finally:
+        writer.close()
+    if 'error' in message:
+        raise RuntimeError(message['error'])
+    return message['result']
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m src.service', description='Serve simulation requests')
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', help='Unix socket path to listen on')
+    address.add_argument('--port', type=int, help='localhost TCP port to listen on')
+    parser.add_argument('--coalesce-window', type=float, default=0.02,
+                        help='seconds to wait for matching requests before running a batch')
+    parser.add_argument('--cache-dir', help='also keep per-strategy results in a ResultCache here')
+    parser.add_argument('--warm', nargs='*', default=[], help='scenario files to prepare at startup')
+    args = parser.parse_args(argv)
+
+    service = SimulationService(
+        coalesce_window=args.coalesce_window,
+        cache=ResultCache(args.cache_dir) if args.cache_dir else None,
+    )
+    service.warm([load_scenario(path) for path in args.warm])
+    if args.socket is not None and os.path.exists(args.socket):
+        os.remove(args.socket)
+    try:
+        asyncio.run(service.serve(socket_path=args.socket, port=args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
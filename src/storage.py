@@ -0,0 +1,81 @@
+import json
+import os
+from typing import Dict, Iterable, Optional
+
+
+import numpy as np
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _write_manifest(run_dir: str, manifest: Dict):
+    with open(os.path.join(run_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def _read_manifest(run_dir: str) -> Dict:
+    with open(os.path.join(run_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def _open_new_memmap(path: str, shape: tuple) -> np.memmap:
+    # Unlink rather than truncate an existing file, so maps still held from an earlier run stay valid
+    if os.path.exists(path):
+        os.remove(path)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=shape)
+
+
+def create_result_arrays(
+    run_dir: str,
+    keys: Iterable[str],
+    fields: Iterable[str],
+    n_years: int,
+    n_sims: int,
+    metadata: Optional[Dict] = None,
+) -> Dict[str, Dict[str, np.memmap]]:
+    # One .npy file per strategy and field, opened for writing as a (n_years, n_sims) memmap.
+    # Strategy names can contain characters that are awkward in paths, so the manifest maps them to
+    # numbered directories.
+    os.makedirs(run_dir, exist_ok=True)
+    manifest = dict(
+        n_years=n_years,
+        n_sims=n_sims,
+        fields=list(fields),
+        strategies=dict(),
+        complete=False,
+        metadata=metadata or dict(),
+    )
+    arrays = dict()
+    for i, key in enumerate(keys):
+        strategy_dir = f'strategy_{i:03d}'
+        os.makedirs(os.path.join(run_dir, strategy_dir), exist_ok=True)
+        manifest['strategies'][key] = strategy_dir
+        arrays[key] = {
+            field: _open_new_memmap(os.path.join(run_dir, strategy_dir, f'{field}.npy'), (n_years, n_sims))
+            for field in manifest['fields']
+        }
+    _write_manifest(run_dir, manifest)
+    return arrays
+
+
+def close_result_arrays(run_dir: str, arrays: Dict[str, Dict[str, np.memmap]]):
+    for strat_arrays in arrays.values():
+        for arr in strat_arrays.values():
+            arr.flush()
+    manifest = _read_manifest(run_dir)
+    manifest['complete'] = True
+    _write_manifest(run_dir, manifest)
+
+
+def load_results(run_dir: str, mmap_mode: str = 'r') -> Dict[str, Dict[str, np.ndarray]]:
+    manifest = _read_manifest(run_dir)
+    if not manifest['complete']:
+        raise ValueError(f'Simulation results in {run_dir} are incomplete')
+    return {
+        key: {
+            field: np.load(os.path.join(run_dir, strategy_dir, f'{field}.npy'), mmap_mode=mmap_mode)
+            for field in manifest['fields']
+        }
+        for key, strategy_dir in manifest['strategies'].items()
+    }
@@ -0,0 +1,116 @@
+from dataclasses import dataclass, field
+from typing import Dict, Sequence, Union
+
+
+import numpy as np
+
+
+@dataclass
+class YearlySummary:
+    n_years: int
+    relative_accuracy: float = 0.01
+    min_value: float = 1.0
+    max_value: float = 1e13
+    count: int = field(default=0, init=False)
+
+    def __post_init__(self):
+        # Log-spaced buckets: bucket 0 holds everything <= min_value, bucket i covers
+        # (min_value * gamma**(i-1), min_value * gamma**i], so any value is within relative_accuracy of
+        # its bucket's representative
+        self.gamma = (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+        self.n_buckets = int(np.ceil(np.log(self.max_value / self.min_value) / np.log(self.gamma))) + 1
+        self.mean = np.zeros(self.n_years)
+        self.m2 = np.zeros(self.n_years)
+        self.min = np.full(self.n_years, np.inf)
+        self.max = np.full(self.n_years, -np.inf)
+        self.bucket_counts = np.zeros((self.n_years, self.n_buckets), dtype=np.int64)
+
+    @property
+    def bucket_values(self) -> np.ndarray:
+        values = self.min_value * 2 * self.gamma ** np.arange(self.n_buckets) / (self.gamma + 1)
+        values[0] = 0.
+        return values
+
+    @property
+    def var(self) -> np.ndarray:
+        return self.m2 / max(self.count - 1, 1)
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.var)
+
+    def _bucket_index(self, values: np.ndarray) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            idx = np.ceil(np.log(values / self.min_value) / np.log(self.gamma))
+        return np.clip(np.nan_to_num(idx, nan=0., neginf=0.), 0, self.n_buckets - 1).astype(np.intp)
+
+    def _merge_moments(self, count: int, mean: np.ndarray, m2: np.ndarray):
+        # Chan et al. pairwise combination of (count, mean, M2)
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    def update(self, paths: np.ndarray) -> 'YearlySummary':
+        # paths is (n_years, n_paths), laid out like the run_simulations result matrices
+        n_paths = paths.shape[1]
+        if n_paths == 0:
+            return self
+        mean = paths.mean(axis=1)
+        m2 = ((paths - mean[:, None]) ** 2).sum(axis=1)
+        self._merge_moments(n_paths, mean, m2)
+        np.minimum(self.min, paths.min(axis=1), out=self.min)
+        np.maximum(self.max, paths.max(axis=1), out=self.max)
+        flat_idx = self._bucket_index(paths) + (np.arange(self.n_years) * self.n_buckets)[:, None]
+        self.bucket_counts += np.bincount(
+            flat_idx.ravel(), minlength=self.n_years * self.n_buckets
+        ).reshape(self.n_years, self.n_buckets)
+        return self
+
+    def merge(self, other: 'YearlySummary') -> 'YearlySummary':
+        if (other.n_years, other.n_buckets, other.gamma) != (self.n_years, self.n_buckets, self.gamma):
+            raise ValueError('Can only merge summaries with the same years and bucket layout')
+        if other.count == 0:
+            return self
+        self._merge_moments(other.count, other.mean, other.m2)
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        self.bucket_counts += other.bucket_counts
+        return self
+
+    def quantile(self, q: Union[float, Sequence[float]]) -> np.ndarray:
+        # Returns (n_years,) for a scalar q, otherwise (len(q), n_years)
+        qs = np.atleast_1d(np.asarray(q, dtype=float))
+        cum_counts = self.bucket_counts.cumsum(axis=1)
+        ranks = qs[:, None] * (self.count - 1)
+        idx = (cum_counts[None, :, :] > ranks[:, :, None]).argmax(axis=2)
+        quantiles = np.clip(self.bucket_values[idx], self.min, self.max)
+        return quantiles[0] if np.ndim(q) == 0 else quantiles
+
+    def histogram(self, bins: np.ndarray, year: int = -1) -> np.ndarray:
+        counts, _ = np.histogram(
+            np.clip(self.bucket_values, self.min[year], self.max[year]),
+            bins=bins,
+            weights=self.bucket_counts[year],
+        )
+        return counts
+
+
+@dataclass
+class SimulationProgress:
+    # One update of iter_simulations, after n_done of n_sims paths. quantiles are (len(percentiles), n_years)
+    # and ending_histograms count final-year balances in bin_edges, both by strategy and field. summaries
+    # are the running YearlySummary objects themselves, which keep updating as later chunks arrive.
+    n_done: int
+    n_sims: int
+    seconds: float
+    percentiles: Sequence[float]
+    quantiles: Dict[str, Dict[str, np.ndarray]] = field(repr=False)
+    bin_edges: Dict[str, np.ndarray] = field(repr=False)
+    ending_histograms: Dict[str, Dict[str, np.ndarray]] = field(repr=False)
+    summaries: Dict[str, Dict[str, YearlySummary]] = field(repr=False)
+
+    @property
+    def fraction_done(self) -> float:
+        return self.n_done / self.n_sims if self.n_sims else 1.
@@ -0,0 +1,140 @@
+import dataclasses
+import itertools
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+
+import numpy as np
+
+
+from src.accounts import Four01k, IRA
+from src.computations import calc_rmd, compute_shortfall, make_workspace, simulate_fused
+from src.inputs import ParametricOptimizationInputs
+from src.interfaces import RetireeClass
+from src.retiree import Retiree, make_ret_arrays
+
+
+SWEEP_FIELDS = ('portfolio_balance', 'portfolio_balance_real')
+
+
+def make_grid(grid: Dict[str, Sequence]) -> List[Dict[str, Any]]:
+    # Cartesian product of the swept values, with the last field varying fastest
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def make_sweep_inputs(
+    base: Dict[str, Any],
+    cells: List[Dict[str, Any]],
+    start_age: int,
+    end_age: int,
+    four01k_kwargs: Optional[Dict[str, Any]] = None,
+    ira_kwargs: Optional[Dict[str, Any]] = None,
+    **starting_balances,
+) -> Dict[str, np.ndarray]:
+    # simulate_fused kwargs with a leading scenario axis, shaped (n_cells, 1, 1, years) so they broadcast
+    # against (n_strategies, n_sims) paths
+    rets = [Retiree(**{**base, **cell}) for cell in cells]
+    ret_401ks = [Four01k(retiree=ret, **(four01k_kwargs or dict())) for ret in rets]
+    ret_iras = [IRA(retiree=ret, **(ira_kwargs or dict())) for ret in rets]
+    ret_arrays = make_ret_arrays(rets, ret_401ks, ret_iras, **starting_balances)
+    window = slice(start_age, end_age + 1)
+    # The RMD schedule depends only on life_expectancy, which make_ret_arrays requires to be shared
+    rmd_t, rmd_r = calc_rmd(rets[0])
+
+    def scenario(arr):
+        return arr[:, None, None, window]
+
+    return dict(
+        roth_contrib=scenario(ret_arrays['total_roth_dep']),
+        trad_contrib=scenario(ret_arrays['total_trad_dep']),
+        withdrawal=scenario(ret_arrays['with']),
+        rmd_take=rmd_t[window],
+        rmd_remain=rmd_r[window],
+        tax_rate=np.array([ret.effective_tax_rate for ret in rets])[:, None, None],
+        inflation=scenario(np.stack([ret.inflation_arr for ret in rets])),
+        retired=(ret_arrays['age'] > np.array([ret.retirement_age for ret in rets])[:, None])[:, None, window],
+    )
+
+
+def run_sweep(
+    base: Dict[str, Any],
+    grid: Dict[str, Sequence],
+    allocation_strats: Dict[str, np.ndarray],
+    rng: ParametricOptimizationInputs,
+    start_age: Optional[int] = None,
+    end_age: Optional[int] = None,
+    n_sims: int = 10_000,
+    chunk_size: int = 65_536,
+    percentiles: Sequence[float] = (5, 25, 50, 75, 95),
+    four01k_kwargs: Optional[Dict[str, Any]] = None,
+    ira_kwargs: Optional[Dict[str, Any]] = None,
+    **starting_balances,
+):
+    # Evaluates every combination of the RetireeClass field values in grid (on top of the Retiree kwargs
+    # in base) against one shared set of return paths. Returns a DataFrame indexed by the swept fields
+    # and strategy, with ending-balance statistics and the probability of a withdrawal going unmet.
+    import pandas as pd
+
+    retiree_fields = {f.name for f in dataclasses.fields(RetireeClass)}
+    unknown = set(grid) - retiree_fields
+    if unknown:
+        raise ValueError(f'Cannot sweep {sorted(unknown)}: not RetireeClass fields')
+    cells = make_grid(grid)
+    if start_age is None:
+        start_age = min(cell.get('age', base.get('age')) for cell in cells)
+    if end_age is None:
+        end_age = base.get('life_expectancy', RetireeClass.life_expectancy)
+    inputs = make_sweep_inputs(base, cells, start_age, end_age, four01k_kwargs, ira_kwargs, **starting_balances)
+    retired = inputs.pop('retired')
+
+    start_time = time.time()
+
+    keys = list(allocation_strats.keys())
+    n_cells, n_strats, n_years = len(cells), len(keys), end_age - start_age + 1
+    allocations = np.stack([allocation_strats[key][start_age: end_age+1] for key in keys])
+    ending = {field: np.empty((n_cells, n_strats, n_sims)) for field in SWEEP_FIELDS}
+    depleted = np.zeros((n_cells, n_strats))
+
+    # Every cell and strategy sees the same return paths (common random numbers); a chunk's size counts
+    # cell-strategy-paths, so memory stays bounded however large the grid is
+    rng.reset()
+    n_chunk = max(1, chunk_size // (n_cells * n_strats))
+    workspace = make_workspace((n_cells, n_strats, min(n_chunk, n_sims)), n_years, allocations.shape[-1])
+    for start in range(0, n_sims, n_chunk):
+        stop = min(start + n_chunk, n_sims)
+        results = simulate_fused(
+            allocations=allocations,
+            rates=rng.generate_batch(stop - start, n_years),
+            workspace={name: arr[..., :stop - start] for name, arr in workspace.items()},
+            **inputs,
+        )
+        # Rounded like simulate_batch, so each cell matches run_simulations for the same retiree.
+        # Results are (n_cells, n_strategies, years, paths).
+        roth = results['roth_balance'].round()
+        portfolio = results['traditional_balance'].round() + roth
+        ending['portfolio_balance'][..., start:stop] = portfolio[..., -1, :]
+        ending['portfolio_balance_real'][..., start:stop] = (
+            results['traditional_balance_real'].round() + results['roth_balance_real'].round()
+        )[..., -1, :]
+        depleted += compute_shortfall(results['roth_withdrawals'].round(), roth, retired).sum(axis=-1)
+
+    stats = dict()
+    for field, values in ending.items():
+        stats[f'{field}_mean'] = values.mean(axis=-1)
+        stats[f'{field}_std'] = values.std(axis=-1)
+        for p, arr in zip(percentiles, np.percentile(values, percentiles, axis=-1)):
+            stats[f'{field}_p{p:g}'] = arr
+    stats['depletion_probability'] = depleted / n_sims
+
+    index = pd.MultiIndex.from_tuples(
+        [tuple(cell.values()) + (key,) for cell in cells for key in keys],
+        names=list(grid) + ['strategy'],
+    )
+    sweep_df = pd.DataFrame({name: arr.ravel() for name, arr in stats.items()}, index=index)
+
+    total_time = time.time() - start_time
+
+    print(f'Done. {n_sims:,} simulations of {end_age - start_age:,} years across {n_cells:,} scenarios '
+          f'and {n_strats:,} strategies took {total_time:0.2f}s')
+    return sweep_df
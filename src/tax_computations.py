@@ -1,6 +1,7 @@
-from copy import deepcopy
+from dataclasses import dataclass
 from datetime import datetime as dt
-from typing import Dict, Optional, Union
+from functools import lru_cache
+from typing import Dict, Optional, Tuple, Union
 
 
 import numpy as np
@@ -9,6 +10,107 @@ import numpy as np
 from cache.tax_data import TAX_LOOKUP
 
 
+@dataclass(frozen=True)
+class TaxTable:
+    bands: np.ndarray
+    rates: np.ndarray
+    base_taxes: np.ndarray
+    rounding_adjustments: np.ndarray
+    round_brackets: bool = False
+
+    @classmethod
+    def from_lookup(cls, brackets: list, rates: list, round_brackets: bool = False) -> 'TaxTable':
+        bands = np.array(brackets, dtype=float)
+        rates = np.array(rates, dtype=float)
+        # Tax owed on each full band below the top (open-ended) band
+        full_taxes = rates[:-1] * np.diff(bands)
+        if round_brackets:
+            full_taxes_ = np.round(full_taxes)
+        else:
+            full_taxes_ = full_taxes
+        base_taxes = np.concatenate(([0.], full_taxes_.cumsum()))
+        # When an income sits exactly on a band edge its own band owes nothing, and the highest band
+        # that does owe tax is the one left unrounded
+        rounding_adjustments = np.zeros_like(base_taxes)
+        adjustment = 0.
+        for k in range(full_taxes.shape[0]):
+            if full_taxes[k] != 0:
+                adjustment = full_taxes[k] - full_taxes_[k]
+            rounding_adjustments[k + 1] = adjustment
+        return cls(bands, rates, base_taxes, rounding_adjustments, round_brackets)
+
+    def compute(self, incomes: np.ndarray) -> np.ndarray:
+        if self.bands.shape[0] == 0:
+            return np.zeros(np.shape(incomes))[()]
+        incomes = np.maximum(incomes, self.bands[0])
+        band_idx = np.clip(np.searchsorted(self.bands, incomes, side='right') - 1, 0, None)
+        partial_taxes = self.rates[band_idx] * (incomes - self.bands[band_idx])
+        if self.round_brackets:
+            partial_taxes = np.where(partial_taxes != 0, partial_taxes, self.rounding_adjustments[band_idx])
+        # [()] unwraps 0-d results so scalar incomes give scalar taxes
+        return (self.base_taxes[band_idx] + partial_taxes)[()]
+
+
+@lru_cache(maxsize=None)
+def compile_tax_tables(
+        tax_year: int,
+        state: str,
+        city: Optional[str] = None,
+) -> Tuple[Tuple[str, str, Dict[str, TaxTable]], ...]:
+    # (key, deduction level, component tables) for the federal, state and city taxes
+    state_lookup = TAX_LOOKUP[tax_year][state]
+    city_lookup = state_lookup.get('LOCALITIES', dict()).get(city, dict()).get('TAXES', dict())
+    return tuple(
+        (key, deduction, {
+            k: TaxTable.from_lookup(v['BRACKETS'], v['RATES'], round_brackets=round_brackets)
+            for k, v in tax_lookup.items()
+        })
+        for key, deduction, tax_lookup, round_brackets in zip(
+            ['FED', state, city],
+            ['FED', 'STATE', 'STATE'],
+            [TAX_LOOKUP[tax_year]['FED']['TAXES'], state_lookup['TAXES'], city_lookup],
+            [False, True, True],
+        )
+    )
+
+
+def compute_income_taxes(
+        taxable_incomes: np.ndarray,
+        state: str,
+        city: Optional[str] = None,
+        tax_year: Optional[int] = None,
+        itemized_federal: float = 0.0,
+        itemized_state: float = 0.0,
+) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    tax_year = tax_year or (dt.today().year - 1)
+    state = str.upper(state)
+    city = str.upper(city) if city is not None else city
+    taxable_incomes = np.asarray(taxable_incomes, dtype=float)
+    deductions = dict(
+        FED=max(itemized_federal, TAX_LOOKUP[tax_year]['FED']['DEDUCTION']),
+        STATE=max(itemized_state, TAX_LOOKUP[tax_year][state]['DEDUCTION']),
+    )
+    estimated_taxes = dict()
+    for key, deduction, tables in compile_tax_tables(tax_year, state, city):
+        for k, table in tables.items():
+            estimated_taxes[f'{key}_{k}'] = table.compute(taxable_incomes - deductions[deduction]).round(2)
+    total_estimated_taxes = sum(estimated_taxes.values(), np.zeros_like(taxable_incomes)).round(2)
+    return estimated_taxes, total_estimated_taxes
+
+
+def compute_after_tax_income(
+        taxable_incomes: np.ndarray,
+        state: str,
+        city: Optional[str] = None,
+        tax_year: Optional[int] = None,
+        itemized_federal: float = 0.0,
+        itemized_state: float = 0.0,
+) -> np.ndarray:
+    _, total_estimated_taxes = compute_income_taxes(
+        taxable_incomes, state, city, tax_year, itemized_federal, itemized_state)
+    return (np.asarray(taxable_incomes, dtype=float) - total_estimated_taxes).round(2)
+
+
 class IncomeTaxes:
     def __init__(
             self,
@@ -36,7 +138,6 @@ class IncomeTaxes:
             city: Optional[str] = None
     ) -> None:
         self.tax_year = tax_year or (dt.today().year - 1)
-        self._fed_lookup = deepcopy(TAX_LOOKUP[self.tax_year]['FED']['TAXES'])
         self.update_state(state)
         self.update_city(city)
 
@@ -48,7 +149,6 @@ class IncomeTaxes:
             raise NotImplementedError(
                 f'No available tax data for {str.upper(state)} in {self.tax_year}')
         self.state = str.upper(state)
-        self._state_lookup = deepcopy(TAX_LOOKUP[self.tax_year][self.state]['TAXES'])
 
     def update_city(
             self,
@@ -62,47 +162,6 @@ class IncomeTaxes:
                 f'No available tax data for {str.upper(city)} '
                 f'in {self.state} in {self.tax_year}')
         self.city = str.upper(city) if city is not None else city
-        self._city_lookup = deepcopy(
-            TAX_LOOKUP[self.tax_year][self.state]['LOCALITIES']
-            .get(self.city, dict())).get('TAXES', dict())
-
-    @staticmethod
-    def _tax_calc(
-            incomes: Union[np.ndarray, float],
-            bands: np.ndarray,
-            rates: np.ndarray,
-            round_brackets: bool = False
-    ):
-        if isinstance(incomes, float):
-            incomes = np.array([incomes])
-            is_float = True
-        else: is_float = False
-        # Broadcast incomes so that we can compute an amount per income, per band
-        incomes_ = np.broadcast_to(incomes, (bands.shape[0] - 1, incomes.shape[0]))
-#         print('incomes', incomes.shape,incomes)
-#         print('incomes_',incomes_.shape,incomes_)
-#         print('bands',bands.shape,bands)
-#         print('rates',rates.shape,rates)
-#         print('incomes_.transpose()',incomes_.transpose().shape, incomes_.transpose())
-#         print('bands[:-1]',bands[:-1].shape, bands[:-1])
-#         print('bands[1:]',bands[1:].shape, bands[1:])
-#         print('np.clip(incomes_.transpose(), bands[:-1], bands[1:])',np.clip(incomes_.transpose(),
-#                                 bands[:-1], bands[1:]).shape, np.clip(incomes_.transpose(),
-#                                 bands[:-1], bands[1:]))
-        # Find amounts in bands for each income
-        amounts_in_bands = np.clip(incomes_.transpose(),
-                                bands[:-1], bands[1:]) - bands[:-1]
-#         print('amounts_in_bands', amounts_in_bands)
-        # Calculate tax per band
-        taxes = rates * amounts_in_bands
-        if round_brackets:
-            unrounded_idxs_ = taxes.shape[1] - 1 - (taxes[:,::-1]!=0).argmax(1)
-            unrounded_ = taxes[np.arange(taxes.shape[0]), unrounded_idxs_]
-            taxes = np.round(taxes)
-            taxes[np.arange(taxes.shape[0]), unrounded_idxs_] = unrounded_
-        # Sum tax bands per income
-        taxes = taxes.sum(axis=1)
-        return taxes[0] if is_float else taxes
 
     def update_calculations(
             self
@@ -110,25 +169,19 @@ class IncomeTaxes:
         # Calculate taxable income at federal and state level
         self.federal_taxable_income = self.taxable_income - self.federal_deduction
         self.state_taxable_income = self.taxable_income - self.state_deduction
-        # Calculate estimated taxes
+        # Calculate estimated taxes from the compiled tables shared with compute_income_taxes
         self.federal_taxes = dict()
         self.state_taxes = dict()
         self.city_taxes = dict()
         self.estimated_taxes = dict()
-        for key, est_tax, tax_income, tax_lookup, round_brackets in zip(
-            ['FED', self.state, self.city],
+        tax_incomes = dict(FED=self.federal_taxable_income, STATE=self.state_taxable_income)
+        for est_tax, (key, deduction, tables) in zip(
             [self.federal_taxes, self.state_taxes, self.city_taxes],
-            [self.federal_taxable_income, self.state_taxable_income, self.state_taxable_income],
-            [self._fed_lookup, self._state_lookup, self._city_lookup],
-            [False, True, True]
+            compile_tax_tables(self.tax_year, self.state, self.city),
         ):
             est_tax.update({
-                f'{key}_{k}' : round(self._tax_calc(
-                    incomes=tax_income,
-                    bands=np.array(v['BRACKETS'] + [np.inf]),
-                    rates=np.array(v['RATES']),
-                    round_brackets=round_brackets), 2)
-                for k,v in tax_lookup.items()
+                f'{key}_{k}': round(table.compute(np.float64(tax_incomes[deduction])), 2)
+                for k, table in tables.items()
             })
             self.estimated_taxes.update(est_tax)
         self.total_estimated_taxes = round(sum(self.estimated_taxes.values()), 2)